@@ -0,0 +1,730 @@
+"""Offline benchmark for the poster generator
+
+Runs TMDBPosterGenerator against a local fake TMDB API / image server and a
+local S3-compatible stand-in, so no credentials or network are needed.
+
+    python benchmark.py                      # all devices, JSON to bench_results.json
+    python benchmark.py --devices Desktop_4K iPhone_14 --repeat 3
+    python benchmark.py --fixtures ./posters --output results.json
+
+Each device runs in its own fresh process so peak RSS is per device. Stages
+reported: fetch, decode, resize, compose, rotate (or render_strips for
+strip-rendered outputs), encode, upload, plus an
+end-to-end run of create_all_device_sizes.
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter
+import PIL
+
+
+FIXTURE_SIZE = (1000, 1500)  # "original" poster size served by the fake CDN
+BUCKET_NAME = 'bench-bucket'
+
+
+def make_fixture_posters(count, seed=42):
+    """Deterministic photo-like poster JPEGs: gradients, shapes, text and noise"""
+    rng = random.Random(seed)
+    width, height = FIXTURE_SIZE
+    posters = []
+    for index in range(count):
+        top = tuple(rng.randrange(256) for _ in range(3))
+        bottom = tuple(rng.randrange(256) for _ in range(3))
+        gradient = Image.linear_gradient('L').resize((width, height))
+        image = Image.composite(Image.new('RGB', (width, height), top),
+                                Image.new('RGB', (width, height), bottom), gradient)
+        draw = ImageDraw.Draw(image)
+        for _ in range(25):
+            x0, y0 = rng.randrange(width), rng.randrange(height)
+            x1, y1 = x0 + rng.randrange(50, 400), y0 + rng.randrange(50, 400)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            if rng.random() < 0.5:
+                draw.ellipse([x0, y0, x1, y1], fill=color)
+            else:
+                draw.rectangle([x0, y0, x1, y1], fill=color)
+        draw.text((40, height - 120), f"FIXTURE POSTER {index}", fill=(255, 255, 255))
+        noise = Image.effect_noise((width, height), 30 + index % 20).convert('RGB')
+        image = Image.blend(image, noise, 0.2).filter(ImageFilter.GaussianBlur(0.8))
+
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=88)
+        posters.append(buffer.getvalue())
+    return posters
+
+
+def load_fixture_posters(directory):
+    """Read poster JPEGs from a directory (sorted by name)"""
+    posters = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(('.jpg', '.jpeg')):
+            with open(os.path.join(directory, name), 'rb') as f:
+                posters.append(f.read())
+    if not posters:
+        raise SystemExit(f"No .jpg fixtures found in {directory}")
+    return posters
+
+
+class FakeTMDBServer:
+    """Local stand-in for api.themoviedb.org and image.tmdb.org
+
+    Serves /3/{movie,tv}/popular pages whose results point at the fixture
+    posters, and /t/p/{size}/{file} images resized to the requested width,
+    with ETag revalidation. Optional per-request latency simulates the WAN.
+    """
+
+    def __init__(self, posters, latency_ms=0):
+        self.posters = posters
+        self.latency = latency_ms / 1000.0
+        self.requests = {'api': 0, 'image': 0, 'not_modified': 0}
+        self.missing = set()  # Poster indexes answered with 404
+        self._sized = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def poster_bytes(self, size, index):
+        """Fixture JPEG resized for a TMDB size name (w185, w500, original, ...)"""
+        key = (size, index)
+        with self._lock:
+            if key in self._sized:
+                return self._sized[key]
+        data = self.posters[index]
+        match = re.match(r'w(\d+)$', size)
+        if match:
+            with Image.open(io.BytesIO(data)) as image:
+                width = int(match.group(1))
+                if width < image.width:
+                    height = round(image.height * width / image.width)
+                    buffer = io.BytesIO()
+                    image.convert('RGB').resize((width, height), Image.LANCZOS).save(buffer, 'JPEG', quality=88)
+                    data = buffer.getvalue()
+        with self._lock:
+            self._sized[key] = data
+        return data
+
+    def warm(self, size):
+        """Pre-resize every fixture so server-side work stays out of the timings"""
+        for index in range(len(self.posters)):
+            self.poster_bytes(size, index)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                parts = urlsplit(self.path)
+                query = parse_qs(parts.query)
+
+                match = re.match(r'/3/(movie|tv)/popular$', parts.path)
+                if match:
+                    with fake._lock:
+                        fake.requests['api'] += 1
+                    self._send(200, fake.popular_page(match.group(1), int(query.get('page', ['1'])[0])),
+                               {'Content-Type': 'application/json'})
+                    return
+
+                match = re.match(r'/t/p/(\w+)/poster_(\d+)\.jpg$', parts.path)
+                if match and int(match.group(2)) < len(fake.posters) and int(match.group(2)) not in fake.missing:
+                    data = fake.poster_bytes(match.group(1), int(match.group(2)))
+                    etag = '"%s"' % hashlib.md5(data).hexdigest()
+                    if self.headers.get('If-None-Match') == etag:
+                        with fake._lock:
+                            fake.requests['not_modified'] += 1
+                        self._send(304, headers={'ETag': etag})
+                        return
+                    with fake._lock:
+                        fake.requests['image'] += 1
+                    self._send(200, data, {'Content-Type': 'image/jpeg', 'ETag': etag})
+                    return
+
+                self._send(404)
+
+        return Handler
+
+    def popular_page(self, media_type, page):
+        offset = 0 if media_type == 'movie' else 1
+        results = []
+        for position in range(20):
+            item_id = (page - 1) * 20 + position
+            index = (item_id * 2 + offset) % len(self.posters)
+            item = {
+                'id': item_id * 2 + offset,
+                'poster_path': f"/poster_{index}.jpg",
+                'genre_ids': [item_id % 5],
+            }
+            item['title' if media_type == 'movie' else 'name'] = f"{media_type} {item_id}"
+            results.append(item)
+        return json.dumps({'page': page, 'results': results}).encode('utf-8')
+
+
+class FakeS3Server:
+    """Minimal path-style S3 stand-in: PUT/GET/HEAD objects and multipart uploads"""
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000.0
+        self.objects = {}  # key -> (body, etag, content type, metadata)
+        self.uploads = {}  # upload id -> {part number: body}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _target(self):
+                parts = urlsplit(self.path)
+                return unquote(parts.path.lstrip('/')), parse_qs(parts.query, keep_blank_values=True)
+
+            def _metadata(self):
+                return {name.lower(): value for name, value in self.headers.items()
+                        if name.lower().startswith('x-amz-meta-')}
+
+            def _body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                        if size == 0:
+                            while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                                pass
+                            break
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                else:
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                # botocore may send aws-chunked bodies with trailing checksums
+                if ('aws-chunked' in self.headers.get('Content-Encoding', '') or
+                        self.headers.get('x-amz-content-sha256', '').startswith('STREAMING')):
+                    decoded, position = b'', 0
+                    while True:
+                        line_end = body.index(b'\r\n', position)
+                        size = int(body[position:line_end].split(b';')[0], 16)
+                        position = line_end + 2
+                        if size == 0:
+                            break
+                        decoded += body[position:position + size]
+                        position += size + 2
+                    body = decoded
+                return body
+
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def do_PUT(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                key, query = self._target()
+                body = self._body()
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                with fake._lock:
+                    if 'uploadId' in query:
+                        fake.uploads[query['uploadId'][0]]['parts'][int(query['partNumber'][0])] = body
+                    else:
+                        fake.objects[key] = (body, etag, self.headers.get('Content-Type', ''), self._metadata())
+                self._send(200, headers={'ETag': etag})
+
+            def do_POST(self):
+                key, query = self._target()
+                self._body()
+                with fake._lock:
+                    if 'uploads' in query:
+                        upload_id = uuid.uuid4().hex
+                        fake.uploads[upload_id] = {
+                            'parts': {},
+                            'content_type': self.headers.get('Content-Type', ''),
+                            'metadata': self._metadata(),
+                        }
+                        body = (f'<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                                f'<Bucket>{BUCKET_NAME}</Bucket><Key>{key}</Key><UploadId>{upload_id}</UploadId>'
+                                f'</InitiateMultipartUploadResult>')
+                        self._send(200, body.encode('utf-8'), {'Content-Type': 'application/xml'})
+                        return
+
+                    upload = fake.uploads.pop(query['uploadId'][0])
+                    parts = upload['parts']
+                    body = b''.join(parts[number] for number in sorted(parts))
+                    etag = '"%s-%d"' % (hashlib.md5(body).hexdigest(), len(parts))
+                    fake.objects[key] = (body, etag, upload['content_type'], upload['metadata'])
+                response = (f'<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                            f'<Bucket>{BUCKET_NAME}</Bucket><Key>{key}</Key><ETag>{etag}</ETag>'
+                            f'</CompleteMultipartUploadResult>')
+                self._send(200, response.encode('utf-8'), {'Content-Type': 'application/xml'})
+
+            def do_GET(self):
+                key, _ = self._target()
+                with fake._lock:
+                    stored = fake.objects.get(key)
+                if stored is None:
+                    body = b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code></Error>'
+                    self._send(404, body, {'Content-Type': 'application/xml'})
+                    return
+                body, etag, content_type, metadata = stored
+                headers = dict(metadata)
+                headers.update({'ETag': etag, 'Content-Type': content_type or 'application/octet-stream'})
+                self._send(200, body, headers)
+
+            do_HEAD = do_GET
+
+            def do_DELETE(self):
+                key, query = self._target()
+                with fake._lock:
+                    if 'uploadId' in query:
+                        fake.uploads.pop(query['uploadId'][0], None)
+                    else:
+                        fake.objects.pop(key, None)
+                self._send(204)
+
+        return Handler
+
+
+def benchmark_environment(s3_url, work_dir):
+    """Environment that points the generator at the fakes and a scratch directory"""
+    return {
+        'TMDB_API_KEY': 'benchmark',
+        'S3_ENABLED': 'true',
+        'S3_ENDPOINT_URL': s3_url,
+        'S3_BUCKET_NAME': BUCKET_NAME,
+        'S3_ACCESS_KEY_ID': 'benchmark',
+        'S3_SECRET_ACCESS_KEY': 'benchmark',
+        'S3_REGION': 'us-east-1',
+        'S3_PATH_PREFIX': 'bench',
+        'S3_PUBLIC_READ': 'false',
+        'POSTER_CACHE_DIR': os.path.join(work_dir, 'posters'),
+        'JPEG_HISTORY_PATH': os.path.join(work_dir, 'jpeg_quality.json'),
+        'FORCE_REGENERATE': 'true',
+    }
+
+
+def _make_generator(tmdb_url, devices=None):
+    import main
+    generator = main.TMDBPosterGenerator('benchmark')
+    generator.base_url = f"{tmdb_url}/3"
+    generator.image_cdn_url = f"{tmdb_url}/t/p"
+    if devices:
+        generator.plan_image_size(devices)
+    else:
+        generator.set_image_size(generator.image_size)
+    return generator
+
+
+def _rss_bytes():
+    """(current RSS, peak RSS) of this process in bytes"""
+    try:
+        values = {}
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    name, value = line.split(':', 1)
+                    values[name] = int(value.split()[0]) * 1024
+        return values['VmRSS'], values['VmHWM']
+    except (OSError, KeyError):
+        # ru_maxrss is KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == 'darwin' else peak * 1024
+        return peak, peak
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageTimer:
+    """Collects wall and CPU time per named stage"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def measure(self, name, func, *args, **kwargs):
+        wall_start, cpu_start = time.perf_counter(), _cpu_seconds()
+        result = func(*args, **kwargs)
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+        stage['wall_seconds'] += time.perf_counter() - wall_start
+        stage['cpu_seconds'] += _cpu_seconds() - cpu_start
+        return result
+
+
+def _device_worker(environment, tmdb_url, device_info, devices, results):
+    """Run one device stage by stage in a fresh process and report timings"""
+    os.environ.update(environment)
+    os.chdir(environment['POSTER_CACHE_DIR'].rsplit(os.sep, 1)[0])
+    import main
+
+    generator = _make_generator(tmdb_url, devices)  # Same poster size as the end-to-end run
+    generator.fetch_and_cache_posters()  # Warm from the shared disk cache
+    rss_before, _ = _rss_bytes()
+
+    timer = StageTimer()
+    wall_start, cpu_start = time.perf_counter(), _cpu_seconds()
+
+    layout = main.GridLayout(*device_info)
+    size = (layout.poster_width, layout.poster_height)
+    tiles = timer.measure('resize', lambda: [
+        generator.tile_cache.get_tile(poster_id, poster, size)
+        for poster_id, poster in zip(generator.poster_pool.poster_ids, generator.poster_pool.posters)
+    ])
+    layout.poster_ids = list(generator.poster_pool.poster_ids)
+
+    if generator.streams(layout):
+        # Compose and rotate are interleaved per strip block
+        canvas = timer.measure('render_strips', generator.render_strips, layout, tiles)
+    else:
+        box = (0, 0, layout.width, layout.height)
+        bounds = layout.grid_bounds(box)
+        region = timer.measure('compose', generator.compose_grid_region, layout, tiles, bounds, box)
+        canvas = timer.measure('rotate', generator.rotate_grid_region, layout, region, bounds, box)
+        del region
+
+    outputs = timer.measure('encode', generator.encode_wallpaper, layout, canvas)
+    timer.measure('upload', generator.store_wallpaper, layout, outputs)
+
+    wall = time.perf_counter() - wall_start
+    cpu = _cpu_seconds() - cpu_start
+    _, peak = _rss_bytes()
+    results.put({
+        'device': device_info[0],
+        'resolution': [layout.width, layout.height],
+        'wall_seconds': wall,
+        'cpu_seconds': cpu,
+        'peak_rss_bytes': peak,
+        'rss_before_render_bytes': rss_before,
+        'stages': timer.stages,
+        'outputs': {name: len(output['data']) for name, output in outputs.items()},
+        'jpeg_quality': outputs['jpeg'].get('quality'),
+        'jpeg_encodes': outputs['jpeg'].get('encodes'),
+    })
+
+
+def _end_to_end_worker(environment, tmdb_url, devices, results):
+    """Run create_all_device_sizes end to end in a fresh process"""
+    os.environ.update(environment)
+    os.chdir(environment['POSTER_CACHE_DIR'].rsplit(os.sep, 1)[0])
+
+    generator = _make_generator(tmdb_url)
+    wall_start, cpu_start = time.perf_counter(), _cpu_seconds()
+    generated = generator.create_all_device_sizes(devices) if devices else generator.create_all_device_sizes()
+    _, peak = _rss_bytes()
+    results.put({
+        'wall_seconds': time.perf_counter() - wall_start,
+        'cpu_seconds': _cpu_seconds() - cpu_start,
+        'peak_rss_bytes': peak,
+        'devices_generated': len(generated),
+    })
+
+
+def _incremental_worker(environment, tmdb_url, devices, results):
+    """Run create_all_device_sizes with the manifest honoured; reports devices rendered"""
+    os.environ.update(environment)
+    os.environ['FORCE_REGENERATE'] = 'false'
+    os.chdir(environment['POSTER_CACHE_DIR'].rsplit(os.sep, 1)[0])
+
+    generator = _make_generator(tmdb_url)
+    generated = generator.create_all_device_sizes(devices)
+    results.put({'devices_generated': len(generated)})
+
+
+def check_incremental(environment, tmdb, devices):
+    """Run twice with a poster missing from the CDN; the second run should skip every device"""
+    # A prefix of its own, so the first run starts without a manifest
+    environment = dict(environment, S3_PATH_PREFIX='bench-incremental')
+    tmdb.missing.add(0)
+    try:
+        first = _run_in_process(_incremental_worker, environment, tmdb.url, devices)
+        second = _run_in_process(_incremental_worker, environment, tmdb.url, devices)
+    finally:
+        tmdb.missing.discard(0)
+    return {
+        'devices': len(devices),
+        'first_generated': first['devices_generated'],
+        'second_generated': second['devices_generated'],
+        'skipped_all': second['devices_generated'] == 0,
+    }
+
+
+def compare_compositors(generator, devices, tolerance=0):
+    """Render each device with both compositors; returns timings and the largest pixel difference"""
+    import main
+
+    results = []
+    for device_info in devices:
+        timings, canvases = {}, {}
+        for compositor in ('pillow', 'numpy'):
+            generator.compositor = compositor
+            started = time.perf_counter()
+            _, canvas = generator.render_wallpaper(*device_info)
+            timings[compositor] = time.perf_counter() - started
+            canvases[compositor] = canvas.convert('RGB')
+        difference = ImageChops.difference(canvases['pillow'], canvases['numpy'])
+        max_difference = max(high for _, high in difference.getextrema())
+        results.append({
+            'device': device_info[0],
+            'pillow_seconds': timings['pillow'],
+            'numpy_seconds': timings['numpy'],
+            'max_pixel_difference': max_difference,
+            'matches': max_difference <= tolerance,
+        })
+    generator.compositor = 'numpy' if main._import_numpy() is not None else 'pillow'
+    return results
+
+
+def master_settings(threads):
+    """(label, generator attributes) for each master encoder setting in the sweep"""
+    settings = []
+    for level in (1, 3, 6, 9):
+        settings.append((f"png level {level}", {'png_compress_level': level, 'png_threads': 1}))
+    for level in (1, 6):
+        settings.append((f"png level {level}, {threads} threads",
+                         {'png_compress_level': level, 'png_threads': threads, 'png_parallel_min_pixels': 0}))
+    for strategy in ('filtered', 'rle', 'huffman'):
+        settings.append((f"png level 6 {strategy}", {'png_strategy': strategy, 'png_threads': 1}))
+    for method in (0, 4):
+        settings.append((f"lossless webp method {method}", {'master_format': 'webp', 'master_webp_method': method}))
+    return settings
+
+
+def sweep_master_settings(generator, device_info):
+    """Encode one rendered canvas with every master setting; returns bytes and seconds for each"""
+    layout, canvas = generator.render_wallpaper(*device_info)
+    reference = canvas.convert('RGB')
+    results = []
+    for label, attributes in master_settings(os.cpu_count() or 1):
+        saved = {name: getattr(generator, name) for name in attributes}
+        for name, value in attributes.items():
+            setattr(generator, name, value)
+        try:
+            started = time.perf_counter()
+            output = generator.encode_format(layout, canvas, 'original')
+            seconds = time.perf_counter() - started
+        finally:
+            for name, value in saved.items():
+                setattr(generator, name, value)
+        decoded = Image.open(io.BytesIO(output['data'])).convert('RGB')
+        results.append({
+            'device': device_info[0],
+            'setting': label,
+            'bytes': len(output['data']),
+            'seconds': seconds,
+            'lossless': ImageChops.difference(decoded, reference).getbbox() is None,
+        })
+    return results
+
+
+def _run_in_process(target, *args):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=target, args=args + (results,))
+    process.start()
+    try:
+        result = results.get(timeout=3600)
+    except Exception:
+        result = None
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError(f"Benchmark worker failed (exit code {process.exitcode})")
+    return result
+
+
+def run_benchmark(args):
+    import main
+
+    if args.fixtures:
+        posters = load_fixture_posters(args.fixtures)
+    else:
+        posters = make_fixture_posters(args.posters)
+
+    tmdb = FakeTMDBServer(posters, latency_ms=args.tmdb_latency_ms).start()
+    s3 = FakeS3Server(latency_ms=args.s3_latency_ms).start()
+    work_dir = tempfile.mkdtemp(prefix='poster-bench-')
+    environment = benchmark_environment(s3.url, work_dir)
+
+    if args.devices:
+        devices = [device for device in main.DEVICES + main.EXTENDED_DEVICES if device[0] in args.devices]
+    else:
+        devices = main.default_devices()
+    if not devices:
+        raise SystemExit("No matching devices")
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'config': {
+            'posters': len(posters),
+            'repeat': args.repeat,
+            'tmdb_latency_ms': args.tmdb_latency_ms,
+            's3_latency_ms': args.s3_latency_ms,
+            'env': {name: os.environ[name] for name in sorted(os.environ)
+                    if name.startswith(('RENDER_', 'COMPOSITOR', 'STREAM_', 'MASTER_', 'ENCODE_', 'PNG_', 'JPEG_', 'WEBP_', 'TILE_', 'TMDB_C', 'S3_UPLOAD', 'S3_MAX', 'S3_MULTI'))},
+        },
+        'fetch': [],
+        'devices': [],
+        'end_to_end': [],
+        'compositors': [],
+        'master': [],
+    }
+
+    saved_environ = dict(os.environ)
+    saved_cwd = os.getcwd()
+    try:
+        os.environ.update(environment)
+        os.chdir(work_dir)
+
+        for repeat in range(args.repeat):
+            # Fetch and decode: cold poster cache on the first pass, then revalidation
+            generator = _make_generator(tmdb.url, devices)
+            tmdb.warm(generator.image_size)
+            timer = StageTimer()
+            tasks = timer.measure('fetch', generator.fetch_poster_list)
+            timer.measure('download', generator.fetch_and_cache_posters, download_tasks=tasks)
+            raw = [tmdb.poster_bytes(generator.image_size, int(re.search(r'(\d+)', path).group(1)))
+                   for path, _ in tasks]
+            timer.measure('decode', lambda: [generator.decode_poster(data) for data in raw])
+            report['fetch'].append(dict(timer.stages, posters=len(generator.poster_pool)))
+            print(f"[{repeat + 1}/{args.repeat}] fetch {timer.stages['fetch']['wall_seconds']:.2f}s, "
+                  f"download {timer.stages['download']['wall_seconds']:.2f}s, "
+                  f"decode {timer.stages['decode']['wall_seconds']:.2f}s")
+
+            if args.compare_compositors and repeat == 0:
+                if main._import_numpy() is None:
+                    print("NumPy is not installed, skipping the compositor comparison")
+                for result in (compare_compositors(generator, devices) if main._import_numpy() is not None else []):
+                    report['compositors'].append(result)
+                    print(f"{result['device']}: pillow {result['pillow_seconds']:.2f}s, "
+                          f"numpy {result['numpy_seconds']:.2f}s, "
+                          f"max difference {result['max_pixel_difference']}"
+                          f"{'' if result['matches'] else ' (MISMATCH)'}")
+
+            if args.master_sweep and repeat == 0:
+                for device_info in devices:
+                    for result in sweep_master_settings(generator, device_info):
+                        report['master'].append(result)
+                        print(f"{result['device']} {result['setting']}: {result['bytes'] / (1024 * 1024):.2f}MB "
+                              f"in {result['seconds']:.2f}s{'' if result['lossless'] else ' (NOT LOSSLESS)'}")
+
+            for device_info in devices:
+                result = _run_in_process(_device_worker, environment, tmdb.url, device_info, devices)
+                result['repeat'] = repeat
+                report['devices'].append(result)
+                stages = ', '.join(f"{name} {stage['wall_seconds']:.2f}s" for name, stage in result['stages'].items())
+                print(f"[{repeat + 1}/{args.repeat}] {result['device']}: {result['wall_seconds']:.2f}s wall, "
+                      f"{result['cpu_seconds']:.2f}s CPU, peak RSS {result['peak_rss_bytes'] / (1024 * 1024):.0f}MB ({stages})")
+
+            if not args.skip_end_to_end:
+                shutil.rmtree(environment['POSTER_CACHE_DIR'], ignore_errors=True)
+                device_arg = devices if args.devices else None
+                result = _run_in_process(_end_to_end_worker, environment, tmdb.url, device_arg)
+                result['repeat'] = repeat
+                report['end_to_end'].append(result)
+                print(f"[{repeat + 1}/{args.repeat}] end to end: {result['wall_seconds']:.2f}s wall, "
+                      f"{result['cpu_seconds']:.2f}s CPU, peak RSS {result['peak_rss_bytes'] / (1024 * 1024):.0f}MB")
+
+        if args.check_incremental:
+            result = check_incremental(environment, tmdb, devices)
+            report['incremental'] = result
+            print(f"incremental: {result['first_generated']} rendered, then {result['second_generated']} "
+                  f"re-rendered with a poster missing{'' if result['skipped_all'] else ' (NOT SKIPPED)'}")
+
+        report['requests'] = dict(tmdb.requests)
+        report['uploaded_objects'] = len(s3.objects)
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        tmdb.stop()
+        s3.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the TMDB poster generator")
+    parser.add_argument('--devices', nargs='*', help="Device names to run, including extended ones "
+                                                     "(default: all, see EXTENDED_DEVICES)")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of passes")
+    parser.add_argument('--posters', type=int, default=60, help="Number of generated fixture posters")
+    parser.add_argument('--fixtures', help="Directory of poster JPEGs to serve instead of generated ones")
+    parser.add_argument('--tmdb-latency-ms', type=float, default=0, help="Simulated latency per TMDB request")
+    parser.add_argument('--s3-latency-ms', type=float, default=0, help="Simulated latency per S3 PUT")
+    parser.add_argument('--skip-end-to-end', action='store_true', help="Only run the per-stage benchmark")
+    parser.add_argument('--compare-compositors', action='store_true',
+                        help="Check the NumPy compositor against Pillow pixel for pixel")
+    parser.add_argument('--master-sweep', action='store_true',
+                        help="Report bytes and encode time of the lossless master for each encoder setting")
+    parser.add_argument('--check-incremental', action='store_true',
+                        help="Check that a second run skips unchanged devices when a poster fails to download")
+    parser.add_argument('--output', default='bench_results.json', help="Where to write JSON results")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    report = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,109 @@
 import requests
-from PIL import Image, ImageDraw, ImageOps
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from PIL import Image, ImageDraw, ImageOps, ImageChops
 import io
 import math
 import random
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, Future
 import threading
 import multiprocessing
-import boto3
-from botocore.exceptions import ClientError
-from dotenv import load_dotenv
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 import mimetypes
+import hashlib
+import json
+import tempfile
+import time
+import sys
+import argparse
+import socket
+import sqlite3
+import uuid
+import mmap
+import struct
+import zlib
+import importlib.util
+from urllib.parse import urlsplit, parse_qs
 
-# Load environment variables
-load_dotenv()
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow built without LittleCMS: embedded colour profiles are ignored
+    ImageCms = None
+
+# boto3, NumPy and http.server are imported when first needed: they take
+# longer to import than everything else, and many runs never use them
+np = None  # Set by _import_numpy()
+
+
+def _import_numpy():
+    """Import NumPy (optional, enables the vectorized compositor); None if not installed"""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+
+def _numpy_installed():
+    """True if NumPy can be imported, found without importing it"""
+    return np is not None or importlib.util.find_spec('numpy') is not None
+
+# Bump when rendering or encoding changes output for the same inputs, so
+# incremental runs regenerate every device once
+RENDER_VERSION = 2
+
+# Device configurations: (name, width, height, scale_factor)
+DEVICES = [
+    # Desktop displays
+    ("Desktop_4K", 3840, 2160, 1),
+    ("Desktop_QHD", 2560, 1440, 1.5),
+    ("Desktop_FHD", 1920, 1080, 2),
+    ("Laptop", 1366, 768, 2.5),
+    
+    # Tablet displays
+    ("iPad_Pro_12.9", 2732, 2048, 1),
+    ("iPad_Air", 2360, 1640, 1),
+    ("iPad_Mini", 2266, 1488, 1),
+    
+    # Phone displays
+    ("iPhone_14_Pro_Max", 1290, 2796, 1),
+    ("iPhone_14", 1170, 2532, 1),
+    ("Android_Large", 1440, 3200, 1),
+    ("Android_Standard", 1080, 2400, 1),
+]
+
+# Larger displays, rendered in strips (enable with EXTENDED_DEVICES=true)
+EXTENDED_DEVICES = [
+    ("Desktop_8K", 7680, 4320, 1),
+    ("Ultrawide_DQHD", 5120, 1440, 1),
+]
+
+
+def default_devices():
+    """DEVICES, plus EXTENDED_DEVICES when EXTENDED_DEVICES=true"""
+    if os.getenv('EXTENDED_DEVICES', 'false').lower() == 'true':
+        return DEVICES + EXTENDED_DEVICES
+    return DEVICES
 
 class S3Storage:
     """Generic S3-compatible storage class (works with AWS S3, Cloudflare R2, etc.)"""
     
-    def __init__(self):
-        self.enabled = os.getenv('S3_ENABLED', 'false').lower() == 'true'
+    def __init__(self, enabled=None):
+        if enabled is None:
+            enabled = os.getenv('S3_ENABLED', 'false').lower() == 'true'
+        self.enabled = enabled
         
         if self.enabled:
             self.endpoint_url = os.getenv('S3_ENDPOINT_URL', None)
@@ -34,13 +118,31 @@ class S3Storage:
                 print("Warning: S3 enabled but missing configuration. Disabling S3 uploads.")
                 self.enabled = False
             else:
-                # Initialize S3 client
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+                from botocore.config import Config
+                from botocore.exceptions import ClientError
+                self.client_error = ClientError
+                
+                # One multipart config shared by every upload
+                mb = 1024 * 1024
+                self.max_concurrency = max(1, int(os.getenv('S3_MAX_CONCURRENCY', '4')))
+                self.transfer_config = TransferConfig(
+                    multipart_threshold=int(float(os.getenv('S3_MULTIPART_THRESHOLD_MB', '8')) * mb),
+                    multipart_chunksize=int(float(os.getenv('S3_MULTIPART_CHUNK_MB', '8')) * mb),
+                    max_concurrency=self.max_concurrency,
+                    use_threads=True
+                )
+                self.upload_workers = max(1, int(os.getenv('S3_UPLOAD_WORKERS', '4')))
+                
+                # Initialize S3 client (thread-safe, shared by all upload workers)
                 self.s3_client = boto3.client(
                     's3',
                     endpoint_url=self.endpoint_url,
                     aws_access_key_id=self.access_key,
                     aws_secret_access_key=self.secret_key,
-                    region_name=self.region
+                    region_name=self.region,
+                    config=Config(max_pool_connections=self.upload_workers * self.max_concurrency + 2)
                 )
                 print(f"S3 storage initialized: {self.bucket_name}")
                 if self.endpoint_url:
@@ -74,23 +176,86 @@ class S3Storage:
                 local_path,
                 self.bucket_name,
                 s3_key,
-                ExtraArgs=extra_args
+                ExtraArgs=extra_args,
+                Config=self.transfer_config
             )
             
-            # Generate URL
-            if self.endpoint_url:
-                # Custom endpoint (like R2)
-                url = f"{self.endpoint_url}/{self.bucket_name}/{s3_key}"
-            else:
-                # Standard AWS S3
-                url = f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{s3_key}"
+            return self.object_url(s3_key)
+            
+        except self.client_error as e:
+            print(f"Error uploading to S3: {e}")
+            return None
+    
+    def upload_bytes(self, data, s3_key, content_type='application/octet-stream', metadata=None, public=None):
+        """Upload an in-memory buffer to S3 (multipart for large objects)"""
+        if not self.enabled:
+            return None
+        
+        try:
+            # Add path prefix if configured
+            s3_key = self.full_key(s3_key)
+            
+            extra_args = {
+                'ContentType': content_type
+            }
+            if metadata:
+                extra_args['Metadata'] = metadata
             
-            return url
+            if self.public_read if public is None else public:
+                extra_args['ACL'] = 'public-read'
+            
+            self.s3_client.upload_fileobj(
+                io.BytesIO(data),
+                self.bucket_name,
+                s3_key,
+                ExtraArgs=extra_args,
+                Config=self.transfer_config
+            )
+            
+            return self.object_url(s3_key)
             
-        except ClientError as e:
+        except self.client_error as e:
             print(f"Error uploading to S3: {e}")
             return None
     
+    def download_bytes(self, s3_key):
+        """Fetch an object's contents, or None if it does not exist"""
+        if not self.enabled:
+            return None
+        
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.full_key(s3_key))
+            return response['Body'].read()
+        except self.client_error as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                print(f"Error downloading from S3: {e}")
+            return None
+    
+    def object_sha256(self, s3_key):
+        """SHA-256 recorded in an object's metadata when it was uploaded, if any"""
+        if not self.enabled:
+            return None
+        
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=self.full_key(s3_key))
+            return response.get('Metadata', {}).get('sha256')
+        except self.client_error:
+            return None
+    
+    def full_key(self, s3_key):
+        """Object key including the configured path prefix"""
+        if self.path_prefix:
+            return f"{self.path_prefix}/{s3_key}"
+        return s3_key
+    
+    def object_url(self, s3_key):
+        """Public URL of an uploaded object (s3_key includes the path prefix)"""
+        if self.endpoint_url:
+            # Custom endpoint (like R2)
+            return f"{self.endpoint_url}/{self.bucket_name}/{s3_key}"
+        # Standard AWS S3
+        return f"https://{self.bucket_name}.s3.{self.region}.amazonaws.com/{s3_key}"
+    
     def upload_directory(self, local_dir, s3_prefix):
         """Upload an entire directory to S3"""
         if not self.enabled:
@@ -112,415 +277,2508 @@ class S3Storage:
         return uploaded_files
 
 
-class TMDBPosterGenerator:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.base_url = "https://api.themoviedb.org/3"
-        self.image_base_url = "https://image.tmdb.org/t/p/w500"
-        self.cached_posters = []  # Cache for reusing posters
-        self.cache_lock = threading.Lock()  # Thread safety for cache
-        self.s3_storage = S3Storage()  # Initialize S3 storage
-        
-    def fetch_popular_content(self, count=12):
-        """Fetch a mix of popular movies and TV series from TMDB"""
-        content = []
-        
-        # Calculate how many of each type to fetch
-        movies_count = count // 2
-        tv_count = count - movies_count
-        
-        # Fetch popular movies from multiple pages for variety
-        print("Fetching movies...")
-        for page in range(1, 4):  # Get from first 3 pages
-            movies_url = f"{self.base_url}/movie/popular?api_key={self.api_key}&page={page}"
+class RenderManifest:
+    """What each device was last rendered from, for incremental runs
+    
+    Stored as manifest.json next to the output (./backgrounds locally, or
+    under the path prefix in the bucket). For every device it keeps a hash
+    of the render inputs and the checksum of every uploaded file.
+    """
+    
+    FILENAME = 'manifest.json'
+    LOCAL_DIR = './backgrounds'
+    
+    def __init__(self, storage, devices=None):
+        self.storage = storage
+        self.devices = devices or {}
+        self.changed = False
+        self._lock = threading.Lock()
+    
+    def load(self):
+        """Read the manifest from the output location (missing or invalid: empty)"""
+        data = None
+        if self.storage.enabled:
+            data = self.storage.download_bytes(self.FILENAME)
+        else:
             try:
-                response = requests.get(movies_url)
-                if response.status_code == 200:
-                    movies = response.json()['results']
-                    content.extend(movies)
-                    if len(content) >= movies_count:
-                        break
-            except Exception as e:
-                print(f"Error fetching movies page {page}: {e}")
+                with open(os.path.join(self.LOCAL_DIR, self.FILENAME), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                pass
         
-        # Fetch popular TV shows from multiple pages
-        print("Fetching TV series...")
-        tv_content = []
-        for page in range(1, 4):  # Get from first 3 pages
-            tv_url = f"{self.base_url}/tv/popular?api_key={self.api_key}&page={page}"
+        self.devices = {}
+        if data:
             try:
-                response = requests.get(tv_url)
-                if response.status_code == 200:
-                    tv_shows = response.json()['results']
-                    tv_content.extend(tv_shows)
-                    if len(tv_content) >= tv_count:
-                        break
-            except Exception as e:
-                print(f"Error fetching TV shows page {page}: {e}")
+                manifest = json.loads(data)
+                if manifest.get('render_version') == RENDER_VERSION:
+                    self.devices = manifest.get('devices', {})
+            except ValueError:
+                print("Warning: Ignoring unreadable render manifest")
+        return self
+    
+    def save(self):
+        """Write the manifest back if any device changed"""
+        if not self.changed:
+            return
+        with self._lock:
+            data = json.dumps({
+                'render_version': RENDER_VERSION,
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'devices': self.devices,
+            }, indent=2, sort_keys=True).encode('utf-8')
         
-        # Mix movies and TV shows
-        content = content[:movies_count] + tv_content[:tv_count]
+        if self.storage.enabled:
+            self.storage.upload_bytes(data, self.FILENAME, 'application/json', public=False)
+        else:
+            os.makedirs(self.LOCAL_DIR, exist_ok=True)
+            path = os.path.join(self.LOCAL_DIR, self.FILENAME)
+            fd, tmp_path = tempfile.mkstemp(dir=self.LOCAL_DIR, prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.changed = False
+    
+    def is_current(self, device_name, inputs_hash):
+        """True if the device was rendered from these inputs and its files still exist"""
+        with self._lock:
+            entry = self.devices.get(device_name)
+        if not entry or entry.get('inputs') != inputs_hash:
+            return False
+        if not self.storage.enabled:
+            return all(os.path.exists(output['location']) for output in entry['outputs'].values())
+        return True
+    
+    def output_sha256(self, device_name, format_name):
+        with self._lock:
+            entry = self.devices.get(device_name, {})
+            return entry.get('outputs', {}).get(format_name, {}).get('sha256')
+    
+    def record(self, result):
+        """Store a rendered device's inputs hash and output checksums"""
+        with self._lock:
+            self.devices[result['device']] = {
+                'inputs': result['inputs'],
+                'outputs': result['outputs'],
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }
+            self.changed = True
+
+
+class UploadQueue:
+    """Bounded pool of concurrent S3 uploads shared by every device
+    
+    Encoded buffers are uploaded straight from memory. The number of queued
+    uploads is capped so encoded output can't pile up faster than it drains.
+    """
+    
+    def __init__(self, storage, max_workers=None, max_pending=None):
+        self.storage = storage
+        max_workers = max_workers or storage.upload_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload')
+        self._slots = threading.BoundedSemaphore(max_pending or max_workers * 2)
+        self._lock = threading.Lock()
+        self.uploads = []  # (s3_key, bytes, seconds, ok)
+    
+    def submit(self, data, s3_key, content_type, metadata=None):
+        """Queue an upload; blocks while the queue is full. Returns a Future of the URL"""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, data, s3_key, content_type, metadata)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+    
+    def _upload(self, data, s3_key, content_type, metadata):
+        started = time.perf_counter()
+        url = self.storage.upload_bytes(data, s3_key, content_type, metadata)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.uploads.append((s3_key, len(data), elapsed, url is not None))
+        status = "Uploaded" if url else "Failed"
+        print(f"  • {status} {s3_key} ({len(data) / 1024:.0f}KB in {elapsed:.2f}s)")
+        return url
+    
+    def summary(self):
+        """Totals and latency figures for finished uploads"""
+        with self._lock:
+            uploads = list(self.uploads)
+        if not uploads:
+            return None
+        latencies = sorted(upload[2] for upload in uploads)
+        return {
+            'objects': len(uploads),
+            'failed': sum(1 for upload in uploads if not upload[3]),
+            'bytes': sum(upload[1] for upload in uploads),
+            'p50_seconds': latencies[len(latencies) // 2],
+            'max_seconds': latencies[-1],
+        }
+
+
+class RenderQueue:
+    """SQLite job queue that render workers on one or more machines claim from
+    
+    A published run stores a snapshot of the poster set plus one job per
+    render group (and variant). A worker claims a job under a lease and renews
+    it while rendering. If the worker dies, the lease runs out and another
+    worker claims the job again, up to QUEUE_MAX_ATTEMPTS times. Finished jobs
+    keep their results, so a crashed run resumes where it stopped.
+    
+    Put QUEUE_PATH on storage every worker can reach with working file locks
+    (a local disk or a shared volume); SQLite does the locking.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            snapshot TEXT NOT NULL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL REFERENCES runs (run_id),
+            payload TEXT NOT NULL,
+            estimate INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_expires REAL,
+            result TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_run_status ON jobs (run_id, status);
+    """
+    
+    def __init__(self, path=None, lease_seconds=None, max_attempts=None):
+        self.path = path or os.getenv('QUEUE_PATH', '.cache/queue.sqlite3')
+        self.lease_seconds = lease_seconds or float(os.getenv('QUEUE_LEASE_SECONDS', '600'))
+        self.max_attempts = max_attempts or int(os.getenv('QUEUE_MAX_ATTEMPTS', '3'))
+        self._local = threading.local()  # sqlite3 connections are per thread
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(self.SCHEMA)
+    
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit; writes that read first use BEGIN IMMEDIATE to take the lock up front
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._local.connection = connection
+        return connection
+    
+    def publish(self, run_id, snapshot, jobs):
+        """Store a run and its (estimate, payload) jobs"""
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT INTO runs (run_id, created_at, snapshot) VALUES (?, ?, ?)',
+                               (run_id, time.time(), json.dumps(snapshot)))
+            connection.executemany('INSERT INTO jobs (run_id, payload, estimate) VALUES (?, ?, ?)',
+                                   [(run_id, json.dumps(payload), estimate) for estimate, payload in jobs])
+    
+    def latest_run(self):
+        """Most recently published run that has not finished, or None"""
+        row = self._connect().execute(
+            'SELECT run_id FROM runs WHERE finished_at IS NULL ORDER BY created_at DESC LIMIT 1'
+        ).fetchone()
+        return row[0] if row else None
+    
+    def snapshot(self, run_id):
+        row = self._connect().execute('SELECT snapshot FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def claim(self, run_id, worker):
+        """Lease the largest claimable job of a run; returns (job_id, payload) or None"""
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            # Jobs whose last allowed attempt was abandoned will not be retried
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired', worker = NULL "
+                "WHERE run_id = ? AND status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (run_id, now, self.max_attempts)
+            )
+            row = connection.execute(
+                "SELECT job_id, payload FROM jobs WHERE run_id = ? AND attempts < ? "
+                "AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                "ORDER BY estimate DESC, job_id LIMIT 1",
+                (run_id, self.max_attempts, now)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE job_id = ?",
+                (worker, now + self.lease_seconds, row[0])
+            )
+        return row[0], json.loads(row[1])
+    
+    def renew(self, job_id, worker):
+        """Extend a lease; False if the job is no longer leased to this worker"""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + self.lease_seconds, job_id, worker)
+        )
+        return cursor.rowcount == 1
+    
+    def hold_lease(self, job_id, worker):
+        """Renew a job's lease in the background until the returned Event is set"""
+        stop = threading.Event()
         
-        # Shuffle for variety
-        random.shuffle(content)
+        def renew_until_stopped():
+            while not stop.wait(self.lease_seconds / 3):
+                if not self.renew(job_id, worker):
+                    print(f"Warning: Lost the lease on job {job_id}")
+                    return
         
-        print(f"Fetched {len(content)} items ({movies_count} movies, {tv_count} TV series)")
-        return content[:count]
+        threading.Thread(target=renew_until_stopped, daemon=True).start()
+        return stop
     
-    def download_poster(self, poster_path):
-        """Download poster image from TMDB"""
-        if not poster_path:
-            return None
+    def complete(self, job_id, worker, results):
+        """Record a job's results; False if the job is no longer leased to this worker"""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = 'done', result = ?, worker = NULL, lease_expires = NULL, error = NULL "
+            "WHERE job_id = ? AND worker = ? AND status = 'leased'",
+            (json.dumps(results), job_id, worker)
+        )
+        return cursor.rowcount == 1
+    
+    def fail(self, job_id, worker, error):
+        """Give the job back for another attempt, or mark it failed after the last one
         
-        full_url = f"{self.image_base_url}{poster_path}"
+        False if the job is no longer leased to this worker.
+        """
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "error = ?, worker = NULL, lease_expires = NULL WHERE job_id = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, str(error), job_id, worker)
+        )
+        return cursor.rowcount == 1
+    
+    def counts(self, run_id):
+        """Number of jobs per status"""
+        rows = self._connect().execute(
+            'SELECT status, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY status', (run_id,)
+        ).fetchall()
+        return dict(rows)
+    
+    def finish(self, run_id):
+        """Mark the run finished once no job is left to run; True for the one caller that did"""
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            open_jobs = connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE run_id = ? AND status IN ('pending', 'leased')", (run_id,)
+            ).fetchone()[0]
+            if open_jobs:
+                return False
+            cursor = connection.execute(
+                'UPDATE runs SET finished_at = ? WHERE run_id = ? AND finished_at IS NULL', (time.time(), run_id)
+            )
+            return cursor.rowcount == 1
+    
+    def results(self, run_id):
+        """Device results of every finished job of a run"""
+        rows = self._connect().execute(
+            "SELECT result FROM jobs WHERE run_id = ? AND status = 'done' ORDER BY job_id", (run_id,)
+        ).fetchall()
+        return [result for row in rows for result in json.loads(row[0])]
+    
+    def runs(self, limit=10):
+        """(run_id, created_at, finished_at) of the latest runs"""
+        return self._connect().execute(
+            'SELECT run_id, created_at, finished_at FROM runs ORDER BY created_at DESC LIMIT ?', (limit,)
+        ).fetchall()
+
+
+class MemoryScheduler:
+    """Starts jobs largest first while their estimated memory fits a budget
+    
+    A job that doesn't fit right now is passed over for smaller ones that do,
+    so big desktop renders run alongside phone renders instead of next to each
+    other. A job larger than the whole budget runs once nothing else is.
+    """
+    
+    def __init__(self, budget_bytes, max_jobs):
+        self.budget_bytes = budget_bytes  # None: no memory limit
+        self.max_jobs = max_jobs
+        self.reserved = 0
+        self.running = 0
+        self._condition = threading.Condition()
+    
+    def admit(self, jobs):
+        """Yield (estimate, job) pairs as each can start; call release() when one ends"""
+        pending = sorted(jobs, key=lambda job: job[0], reverse=True)
+        while pending:
+            with self._condition:
+                job = self._next(pending)
+                while job is None:
+                    self._condition.wait()
+                    job = self._next(pending)
+                pending.remove(job)
+                self.reserved += job[0]
+                self.running += 1
+            yield job
+    
+    def _next(self, pending):
+        if self.running >= self.max_jobs:
+            return None
+        if self.running == 0 or self.budget_bytes is None:
+            return pending[0]
+        for job in pending:
+            if self.reserved + job[0] <= self.budget_bytes:
+                return job
+        return None
+    
+    def release(self, estimate):
+        with self._condition:
+            self.reserved -= estimate
+            self.running -= 1
+            self._condition.notify_all()
+
+
+def _cgroup_memory_limit():
+    """Container memory limit from cgroup v2 or v1, if one is set"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
         try:
-            response = requests.get(full_url)
-            if response.status_code == 200:
-                return Image.open(io.BytesIO(response.content))
-        except Exception as e:
-            print(f"Error downloading poster: {e}")
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 2 ** 60:  # v1 reports "no limit" as a huge number
+            return int(value)
+    return None
+
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
         return None
+
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def render_memory_budget():
+    """Bytes renders may use at once: RENDER_MEMORY_BUDGET_MB, else a share of the memory limit"""
+    configured = os.getenv('RENDER_MEMORY_BUDGET_MB')
+    if configured:
+        return int(float(configured) * 1024 * 1024)
+    limit = _cgroup_memory_limit() or _physical_memory()
+    if not limit:
+        return None
+    # Leave headroom for the allocator, caches and what this process already holds
+    fraction = float(os.getenv('RENDER_MEMORY_FRACTION', '0.75'))
+    return max(0, int(limit * fraction) - _current_rss_bytes())
+
+
+class RunMetrics:
+    """Stage timings and counters for one generator run
     
-    def fetch_and_cache_posters(self, count=40):
-        """Fetch posters once and cache them for reuse with parallel downloads"""
-        if self.cached_posters:
-            return self.cached_posters
-        
-        print("\nFetching diverse content from TMDB (one-time fetch)...")
-        content = self.fetch_popular_content(count=count)
-        
-        # Prepare download tasks
-        download_tasks = []
-        for item in content:
-            poster_path = item.get('poster_path')
-            if poster_path:
-                title = item.get('title') or item.get('name', 'Unknown')
-                download_tasks.append((poster_path, title))
+    Events are appended as JSON lines to METRICS_PATH (default
+    logs/metrics.jsonl) while the run progresses. The run summary can also be
+    written as a Prometheus textfile (METRICS_TEXTFILE, for node_exporter's
+    textfile collector) and/or pushed to a Pushgateway (METRICS_PUSHGATEWAY_URL).
+    """
+    
+    PREFIX = 'poster_generator'
+    
+    def __init__(self, path=None, textfile=None, pushgateway_url=None, job=None):
+        self.path = os.getenv('METRICS_PATH', 'logs/metrics.jsonl') if path is None else path
+        self.textfile = textfile or os.getenv('METRICS_TEXTFILE') or None
+        self.pushgateway_url = (pushgateway_url or os.getenv('METRICS_PUSHGATEWAY_URL') or '').rstrip('/') or None
+        self.job = job or os.getenv('METRICS_JOB', 'poster_generator')
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{os.getpid()}"
+        self.started = time.time()
+        self.stages = {}  # stage name -> seconds
+        self.devices = {}  # device name -> device metrics
+        self._lock = threading.Lock()
+    
+    def event(self, event, **fields):
+        """Append one event to the JSON lines log"""
+        if not self.path:
+            return
+        record = {'ts': round(time.time(), 3), 'run_id': self.run_id, 'event': event}
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, 'a') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Warning: Could not write metrics: {e}")
+    
+    def stage(self, name, seconds, **fields):
+        """Record a run-level stage (fetch, download, ...)"""
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.event('stage', stage=name, seconds=round(seconds, 4), **fields)
+    
+    def device(self, result):
+        """Record the metrics carried by a device's render result"""
+        metrics = dict(result['metrics'])
+        metrics['output_bytes'] = {
+            format_name: output['bytes'] for format_name, output in result['outputs'].items()
+        }
+        with self._lock:
+            self.devices[result['device']] = metrics
+        self.event('device', device=result['device'], complete=result['complete'], **metrics)
+    
+    def finish(self, **summary):
+        """Log the run summary and export it to Prometheus if configured"""
+        seconds = time.time() - self.started
+        self.event('run', seconds=round(seconds, 3), **summary)
+        if not (self.textfile or self.pushgateway_url):
+            return
+        text = self.prometheus_text(seconds, summary)
+        if self.textfile:
+            try:
+                directory = os.path.dirname(self.textfile) or '.'
+                os.makedirs(directory, exist_ok=True)
+                # node_exporter must never read a half-written file
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.prom')
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                os.replace(tmp_path, self.textfile)
+            except OSError as e:
+                print(f"Warning: Could not write Prometheus textfile: {e}")
+        if self.pushgateway_url:
+            try:
+                response = requests.put(
+                    f"{self.pushgateway_url}/metrics/job/{self.job}",
+                    data=text.encode('utf-8'),
+                    headers={'Content-Type': 'text/plain; version=0.0.4'},
+                    timeout=10
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print(f"Warning: Could not push metrics: {e}")
+    
+    def prometheus_text(self, seconds, summary):
+        """Run summary in the Prometheus text exposition format"""
+        lines = []
         
-        print(f"\nDownloading {len(download_tasks)} posters (5 concurrent downloads)...")
+        def metric(name, help_text, samples):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP {self.PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {self.PREFIX}_{name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+                series = f"{self.PREFIX}_{name}{{{label_text}}}" if label_text else f"{self.PREFIX}_{name}"
+                lines.append(f"{series} {value}")
         
-        # Download posters in parallel with max 5 concurrent downloads
-        downloaded_count = 0
-        lock = threading.Lock()
+        with self._lock:
+            stages = dict(self.stages)
+            devices = dict(self.devices)
         
-        def download_with_progress(task_data):
-            poster_path, title = task_data
-            poster = self.download_poster(poster_path)
-            if poster:
-                with lock:
-                    nonlocal downloaded_count
-                    downloaded_count += 1
-                    print(f"[{downloaded_count}/{len(download_tasks)}] Downloaded: {title}")
-                return poster
-            return None
+        success = summary.get('status') == 'success'
+        metric('last_run_timestamp_seconds', 'End of the last run', [({}, round(time.time(), 3))])
+        metric('last_success_timestamp_seconds', 'End of the last successful run',
+               [({}, round(time.time(), 3) if success else None)])
+        metric('run_success', '1 if every device was generated', [({}, int(success))])
+        metric('run_seconds', 'Duration of the last run', [({}, round(seconds, 3))])
+        metric('stage_seconds', 'Time spent in run-level stages',
+               [({'stage': name}, round(value, 4)) for name, value in stages.items()])
+        metric('devices', 'Devices by outcome in the last run',
+               [({'status': status}, summary.get(f"devices_{status}"))
+                for status in ('generated', 'skipped', 'failed')])
+        metric('transfer_bytes', 'Bytes moved in the last run',
+               [({'direction': 'downloaded'}, summary.get('bytes_downloaded')),
+                ({'direction': 'uploaded'}, summary.get('bytes_uploaded'))])
+        metric('cache_hit_ratio', 'Cache hit ratio in the last run',
+               [({'cache': name}, summary.get(f"{name}_cache_hit_ratio")) for name in ('tile', 'poster')])
+        metric('tmdb_retries', 'TMDB requests retried in the last run', [({}, summary.get('tmdb_retries'))])
+        metric('device_stage_seconds', 'Time spent per device and render stage',
+               [({'device': device, 'stage': stage}, round(value, 4))
+                for device, metrics in devices.items() for stage, value in metrics['seconds'].items()])
+        metric('device_peak_rss_bytes', 'Peak resident memory when the device finished',
+               [({'device': device}, metrics.get('peak_rss_bytes')) for device, metrics in devices.items()])
+        metric('device_output_bytes', 'Encoded size per device and format',
+               [({'device': device, 'format': format_name}, size)
+                for device, metrics in devices.items() for format_name, size in metrics['output_bytes'].items()])
+        metric('device_jpeg_encodes', 'Full-size JPEG encodes per device',
+               [({'device': device}, metrics.get('jpeg_encodes')) for device, metrics in devices.items()])
+        return '\n'.join(lines) + '\n'
+
+
+_SRGB_PROFILE = None
+
+
+def _srgb_profile():
+    """sRGB profile posters are converted to, created on first use"""
+    global _SRGB_PROFILE
+    if _SRGB_PROFILE is None:
+        _SRGB_PROFILE = ImageCms.createProfile('sRGB')
+    return _SRGB_PROFILE
+
+
+def _adler32_combine(adler1, adler2, length2):
+    """Adler-32 of two byte strings joined, from their checksums (zlib's adler32_combine)"""
+    base = 65521
+    remainder = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % base
+    sum1 = (sum1 + (adler2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - remainder) % base
+    return sum1 | (sum2 << 16)
+
+
+def _image_nbytes(image):
+    """Bytes Pillow holds for an image's pixels (multi-band modes use 4 per pixel)"""
+    return image.width * image.height * (4 if len(image.getbands()) > 1 else 1)
+
+
+def _peak_rss_bytes():
+    """Peak resident memory of this process so far (None where unsupported)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # macOS reports bytes, Linux KiB
+
+
+class TMDBClient:
+    """Pooled HTTP client for the TMDB API and image CDN
+    
+    One keep-alive Session is shared by all worker threads. Requests time
+    out, and 429/5xx responses or connection errors are retried with
+    jittered exponential backoff, honoring Retry-After when TMDB sends it.
+    """
+    
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    
+    def __init__(self, concurrency=None, timeout=None, max_retries=None):
+        self.concurrency = concurrency or max(1, int(os.getenv('TMDB_CONCURRENCY', '8')))
+        self.timeout = timeout or float(os.getenv('TMDB_TIMEOUT', '10'))
+        if max_retries is None:
+            max_retries = int(os.getenv('TMDB_MAX_RETRIES', '5'))
+        self.max_retries = max_retries
+        self.backoff_base = 0.5  # seconds
+        self.backoff_cap = 30.0  # seconds
+        self.retries = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
         
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_task = {executor.submit(download_with_progress, task): task 
-                            for task in download_tasks}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def get(self, url, headers=None):
+        """GET a URL, retrying rate-limited, failed and timed-out requests"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                    with self._lock:
+                        self.bytes_received += len(response.content)
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                response.close()
             
-            for future in as_completed(future_to_task):
-                poster = future.result()
-                if poster:
-                    self.cached_posters.append(poster)
+            with self._lock:
+                self.retries += 1
+            time.sleep(delay)
+    
+    def map(self, func, items):
+        """Run func over items on up to `concurrency` threads, preserving order"""
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as executor:
+            return list(executor.map(func, items))
+    
+    def _backoff(self, attempt):
+        # Full jitter keeps parallel workers from retrying in lockstep
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+    
+    def _retry_after(self, response):
+        """Seconds to wait according to a Retry-After header, if present"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(self.backoff_cap, max(0.0, delay))
+
+
+class PosterDiskCache:
+    """Persistent poster cache on disk, shareable between runs and containers
+    
+    Entries are addressed by a hash of (image size, poster_path). Each entry
+    is an image file plus a JSON sidecar holding the ETag/Last-Modified
+    headers used to revalidate it. Files are written atomically so several
+    containers can share one mounted cache directory.
+    """
+    
+    def __init__(self, cache_dir=None, max_bytes=None):
+        if cache_dir is None:
+            cache_dir = os.getenv('POSTER_CACHE_DIR', '.cache/posters')
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('POSTER_CACHE_MAX_MB', '500')) * 1024 * 1024)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = bool(cache_dir) and max_bytes > 0
+        self.revalidated = 0  # 304 responses served from disk
+        self.downloaded = 0  # full downloads stored to disk
+        self._lock = threading.Lock()
         
-        print(f"\nCached {len(self.cached_posters)} posters for reuse")
-        return self.cached_posters
+        if self.enabled:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError as e:
+                print(f"Warning: Poster cache disabled ({cache_dir}: {e})")
+                self.enabled = False
     
-    def create_tilted_grid_wallpaper(self, device_name, width, height, scale_factor=1):
-        """Create a tilted poster grid wallpaper"""
-        # Scale up for high resolution
-        width = int(width * scale_factor)
-        height = int(height * scale_factor)
+    def _paths(self, poster_path, size):
+        key = hashlib.sha256(f"{size}:{poster_path}".encode('utf-8')).hexdigest()
+        entry_dir = os.path.join(self.cache_dir, key[:2])
+        return entry_dir, os.path.join(entry_dir, f"{key}.img"), os.path.join(entry_dir, f"{key}.json")
+    
+    def load(self, poster_path, size):
+        """Return (image bytes, metadata) for a cached poster, or (None, None)"""
+        if not self.enabled:
+            return None, None
         
-        print(f"\nCreating {device_name} wallpaper ({width}x{height} @ {scale_factor}x)...")
+        _, data_path, meta_path = self._paths(poster_path, size)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return None, None
         
-        # Fixed poster dimensions for consistency
-        base_poster_width = 200
-        base_poster_height = 300
-        gap = int(5 * scale_factor)  # Minimal gap between posters
+        if meta.get('sha256') != hashlib.sha256(data).hexdigest():
+            # Torn or corrupted entry; treat as a miss
+            return None, None
+        return data, meta
+    
+    def validators(self, meta):
+        """Conditional request headers for a cached entry"""
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+    
+    def touch(self, poster_path, size):
+        """Mark an entry as recently used (eviction is least recently used first)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.revalidated += 1
+        _, data_path, meta_path = self._paths(poster_path, size)
+        for path in (data_path, meta_path):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+    
+    def store(self, poster_path, size, data, headers):
+        """Atomically write a downloaded poster and its validators"""
+        if not self.enabled:
+            return
         
-        # Scale poster size based on device type and dimensions
-        aspect_ratio = width / height
+        entry_dir, data_path, meta_path = self._paths(poster_path, size)
+        meta = {
+            'poster_path': poster_path,
+            'size': size,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'bytes': len(data),
+            'stored_at': time.time(),
+        }
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            self._write_atomic(data_path, data)
+            self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+            with self._lock:
+                self.downloaded += 1
+        except OSError as e:
+            print(f"Warning: Could not cache poster {poster_path}: {e}")
+    
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def evict(self):
+        """Delete least recently used entries until the cache fits its size budget"""
+        if not self.enabled:
+            return 0
         
-        # Detect device type and adjust accordingly
-        if width > 3000:  # 4K displays
-            poster_scale = 1.2
-        elif width > 2000:  # QHD displays
-            poster_scale = 1.0
-        elif width > 1500:  # FHD displays
-            poster_scale = 0.8
-        elif aspect_ratio < 0.6:  # Phone displays (portrait)
-            # Make posters larger for phones
-            if height > 2500:  # Large phones
-                poster_scale = 1.0
-            else:  # Standard phones
-                poster_scale = 0.9
-        else:  # Tablets and other displays
-            poster_scale = 0.7
+        entries = {}
+        total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue  # Removed by another process
+                if name.startswith('.tmp-'):
+                    # Leftover from an interrupted write
+                    if time.time() - stat.st_mtime > 3600:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                key = os.path.join(root, name.rsplit('.', 1)[0])
+                size, mtime = entries.get(key, (0, 0))
+                entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+                total_bytes += stat.st_size
         
-        # Special handling for specific device types
-        if "iPhone" in device_name or "Android" in device_name:
+        removed = 0
+        for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if total_bytes <= self.max_bytes:
+                break
+            for suffix in ('.json', '.img'):
+                try:
+                    os.remove(key + suffix)
+                except OSError:
+                    pass
+            total_bytes -= size
+            removed += 1
+        return removed
+
+
+class JpegQualityModel:
+    """Finds the highest JPEG quality that fits a size budget with few full encodes
+    
+    A downsampled copy of the image is cheap to encode at any quality. Scaled by
+    the full/sample size ratio, remembered per device across runs, it predicts
+    the full-size JPEG size, so the search starts next to the answer. Each full
+    encode recalibrates the ratio and narrows the bracket, and the best fitting
+    encode is returned as-is instead of being encoded again.
+    """
+    
+    MIN_QUALITY = 50
+    MAX_QUALITY = 95
+    TOLERANCE = 3  # Stop once the best fit is this close to a known miss
+    MAX_FULL_ENCODES = 4
+    SAMPLE_PIXELS = 500000  # Approximate size of the downsampled probe image
+    
+    def __init__(self, history_path=None, optimize=None, max_entries=None):
+        if history_path is None:
+            history_path = os.getenv('JPEG_HISTORY_PATH', '.cache/jpeg_quality.json')
+        if optimize is None:
+            optimize = os.getenv('JPEG_OPTIMIZE', 'true').lower() == 'true'
+        self.history_path = history_path
+        self.optimize = optimize  # Extra Huffman pass: smaller files, slower encode
+        self.max_entries = max_entries  # Keep only the most recent keys (in memory)
+        self._lock = threading.Lock()
+        self._history = OrderedDict(self._read_history())
+    
+    def _read_history(self):
+        if not self.history_path:
+            return {}
+        try:
+            with open(self.history_path, 'r') as f:
+                history = json.load(f)
+            return history if isinstance(history, dict) else {}
+        except (OSError, ValueError):
+            return {}
+    
+    def _save_history(self, key, entry):
+        with self._lock:
+            self._history[key] = entry
+            self._history.move_to_end(key)
+            if self.max_entries:
+                while len(self._history) > self.max_entries:
+                    self._history.popitem(last=False)
+            if not self.history_path:
+                return
+            # Merge with entries written by other workers since we loaded
+            history = self._read_history()
+            history[key] = entry
+            try:
+                directory = os.path.dirname(self.history_path) or '.'
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(history, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.history_path)
+            except OSError as e:
+                print(f"Warning: Could not save JPEG quality history: {e}")
+    
+    def _encode(self, image, quality):
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality, optimize=self.optimize)
+        return buffer.getvalue()
+    
+    def encode(self, image, target_bytes, key):
+        """Return (jpeg bytes, quality, full-size encodes) for the best fit under target_bytes"""
+        pixels = image.width * image.height
+        factor = max(1, int(math.sqrt(pixels / self.SAMPLE_PIXELS)))
+        sample = image.reduce(factor) if factor > 1 else image
+        
+        sample_sizes = {}
+        
+        def sample_size(quality):
+            if quality not in sample_sizes:
+                sample_sizes[quality] = len(self._encode(sample, quality))
+            return sample_sizes[quality]
+        
+        with self._lock:
+            previous = self._history.get(key)
+        if previous and previous.get('ratio'):
+            ratio = previous['ratio']
+        else:
+            # Downsampled images carry more detail per pixel; this is only a first guess
+            ratio = 0.7 * pixels / (sample.width * sample.height)
+        
+        def predict(low, high):
+            """Highest quality in [low, high] predicted to fit, or None"""
+            if low > high or sample_size(low) * ratio > target_bytes:
+                return None
+            while low < high:
+                middle = (low + high + 1) // 2
+                if sample_size(middle) * ratio <= target_bytes:
+                    low = middle
+                else:
+                    high = middle - 1
+            return low
+        
+        best_quality, best_data = None, None
+        smallest_quality, smallest_data = None, None
+        miss_quality = self.MAX_QUALITY + 1
+        quality = predict(self.MIN_QUALITY, self.MAX_QUALITY) or self.MIN_QUALITY
+        full_encodes = 0
+        
+        while full_encodes < self.MAX_FULL_ENCODES:
+            data = self._encode(image, quality)
+            full_encodes += 1
+            ratio = len(data) / sample_size(quality)
+            
+            if smallest_data is None or len(data) < len(smallest_data):
+                smallest_quality, smallest_data = quality, data
+            
+            if len(data) <= target_bytes:
+                best_quality, best_data = quality, data
+                if miss_quality - quality <= self.TOLERANCE:
+                    break
+                next_quality = predict(quality + 1, miss_quality - 1)
+                if next_quality is None:
+                    break  # Recalibrated model says nothing higher fits
+            else:
+                miss_quality = quality
+                if quality <= self.MIN_QUALITY:
+                    break
+                if best_quality is not None and quality - best_quality <= self.TOLERANCE:
+                    break
+                low = best_quality + 1 if best_quality is not None else self.MIN_QUALITY
+                next_quality = predict(low, quality - 1)
+                if next_quality is None:
+                    if best_quality is not None:
+                        break
+                    next_quality = low
+            quality = next_quality
+        
+        if best_data is None:
+            # Nothing fit the budget; use the smallest encode we made
+            best_quality, best_data = smallest_quality, smallest_data
+        
+        self._save_history(key, {
+            'ratio': ratio,
+            'quality': best_quality,
+            'bytes': len(best_data),
+            'target_bytes': target_bytes,
+        })
+        return best_data, best_quality, full_encodes
+
+
+class TileCache:
+    """Thread-safe LRU cache of resized poster tiles, bounded by a byte budget"""
+    
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('TILE_CACHE_MAX_MB', '256')) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()  # (poster_id, size, mode) -> resized tile
+        self._pending = {}  # keys currently being resized by some thread
+        self._lock = threading.Lock()
+    
+    def get_tile(self, poster_id, poster, size):
+        """Return the poster resized to size, resizing at most once per key"""
+        size = tuple(size)
+        key = (poster_id, size, poster.mode)
+        
+        while True:
+            with self._lock:
+                tile = self._tiles.get(key)
+                if tile is not None:
+                    self._tiles.move_to_end(key)
+                    self.hits += 1
+                    return tile
+                
+                pending = self._pending.get(key)
+                if pending is None:
+                    # This thread does the resize; others wait for it
+                    pending = threading.Event()
+                    self._pending[key] = pending
+                    self.misses += 1
+                    break
+            
+            pending.wait()
+        
+        try:
+            tile = poster.resize(size, Image.LANCZOS)
+            if tile.mode == 'RGBX':
+                # Shared-memory posters are RGBX; convert once, not on every paste
+                tile = tile.convert('RGB')
+            self._store(key, tile)
+            return tile
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.set()
+    
+    def _store(self, key, tile):
+        """Insert a tile and evict least recently used tiles over budget"""
+        tile_bytes = _image_nbytes(tile)
+        if tile_bytes > self.max_bytes:
+            return
+        
+        with self._lock:
+            self._tiles[key] = tile
+            self.current_bytes += tile_bytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.current_bytes -= _image_nbytes(evicted)
+    
+    def stats(self):
+        """Return hit/miss counters and current memory use"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'tiles': len(self._tiles),
+                'bytes': self.current_bytes,
+            }
+
+
+class PosterPool:
+    """An immutable set of decoded RGB posters, in grid order
+    
+    A new poster set is built as a new pool and swapped in with a single
+    assignment. A render reads whichever pool it started with, so readers
+    never take a lock or copy the lists.
+    """
+    
+    def __init__(self, poster_ids=(), posters=(), digests=(), planned_ids=None):
+        self.poster_ids = tuple(poster_ids)
+        # Ids the pool was fetched for, including posters that failed or were
+        # duplicates; the render manifest hashes these so it can skip before downloading
+        self.planned_ids = self.poster_ids if planned_ids is None else tuple(planned_ids)
+        self.posters = tuple(posters)
+        self.digests = tuple(digests)  # SHA-256 of each poster's downloaded bytes
+        self.by_id = dict(zip(self.poster_ids, self.posters))
+        # Identifies the content, not just the ids (used by the render server's cache)
+        self.version = hashlib.sha256('\n'.join(self.digests or self.poster_ids).encode('utf-8')).hexdigest()[:12]
+    
+    def __len__(self):
+        return len(self.posters)
+    
+    def select(self, poster_ids):
+        """(ids, posters) for the given ids that are in the pool, in the given order"""
+        poster_ids = [poster_id for poster_id in poster_ids if poster_id in self.by_id]
+        return poster_ids, [self.by_id[poster_id] for poster_id in poster_ids]
+    
+    @property
+    def nbytes(self):
+        return sum(_image_nbytes(poster) for poster in self.posters)
+
+
+class SharedPosterStore:
+    """Decoded posters packed into one shared-memory block for worker processes
+    
+    Posters are stored as raw RGBX rows (the layout Pillow uses in memory for
+    RGB), so worker processes can wrap them with Image.frombuffer without
+    decoding or copying.
+    """
+    
+    def __init__(self, shm, index, owner=False):
+        self.shm = shm
+        self.index = index  # [(poster_id, offset, width, height), ...]
+        self.owner = owner
+    
+    @classmethod
+    def create(cls, posters, poster_ids):
+        """Copy decoded posters into a new shared-memory block"""
+        rgbx_posters = [poster.convert('RGBX') for poster in posters]
+        total_bytes = sum(poster.width * poster.height * 4 for poster in rgbx_posters)
+        shm = shared_memory.SharedMemory(create=True, size=max(total_bytes, 1))
+        
+        index = []
+        offset = 0
+        for poster_id, poster in zip(poster_ids, rgbx_posters):
+            data = poster.tobytes()
+            shm.buf[offset:offset + len(data)] = data
+            index.append((poster_id, offset, poster.width, poster.height))
+            offset += len(data)
+        
+        return cls(shm, index, owner=True)
+    
+    @classmethod
+    def attach(cls, descriptor):
+        """Open a store created by another process"""
+        name, index = descriptor
+        return cls(shared_memory.SharedMemory(name=name), index)
+    
+    def descriptor(self):
+        """Picklable handle passed to worker processes"""
+        return self.shm.name, self.index
+    
+    def poster_ids(self):
+        return [entry[0] for entry in self.index]
+    
+    def images(self):
+        """Zero-copy, read-only images backed by the shared block"""
+        return [
+            Image.frombuffer(
+                'RGBX',
+                (width, height),
+                self.shm.buf[offset:offset + width * height * 4],
+                'raw', 'RGBX', 0, 1
+            )
+            for _, offset, width, height in self.index
+        ]
+    
+    def close(self):
+        """Release the block (and remove it if this process created it)"""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class GridLayout:
+    """Geometry of a tilted poster grid rendered at one output size
+    
+    The grid is laid out on a square canvas of diagonal * 1.2 per side, rotated
+    about its center and center-cropped to the output size. Instead of building
+    that canvas, the layout maps output pixels straight back to grid coordinates
+    so only the cells that reach the output have to be drawn.
+    """
+    
+    # Padding (in grid pixels) kept around a region for the bicubic kernel
+    RESAMPLE_MARGIN = 3
+    
+    def __init__(self, device_name, width, height, scale_factor=1, angle=-15):
+        # Scale up for high resolution
+        self.device_name = device_name
+        self.scale_factor = scale_factor
+        self.width = width = int(width * scale_factor)
+        self.height = height = int(height * scale_factor)
+        self.angle = angle  # Tilt angle
+        self.variant = None  # WallpaperVariant when rendered as part of a batch
+        self.output_name = device_name  # Name of the output files
+        self.poster_ids = None  # Posters used, in order (set when rendered)
+        self.planned_ids = None  # Posters the render was planned with, hashed by the manifest
+        self.timings = {}  # Seconds spent per render stage (set when rendered)
+        
+        # Fixed poster dimensions for consistency
+        base_poster_width = 200
+        base_poster_height = 300
+        gap = int(5 * scale_factor)  # Minimal gap between posters
+        
+        # Scale poster size based on device type and dimensions
+        aspect_ratio = width / height
+        
+        # Detect device type and adjust accordingly
+        if width > 3000:  # 4K displays
+            poster_scale = 1.2
+        elif width > 2000:  # QHD displays
+            poster_scale = 1.0
+        elif width > 1500:  # FHD displays
+            poster_scale = 0.8
+        elif aspect_ratio < 0.6:  # Phone displays (portrait)
+            # Make posters larger for phones
+            if height > 2500:  # Large phones
+                poster_scale = 1.0
+            else:  # Standard phones
+                poster_scale = 0.9
+        else:  # Tablets and other displays
+            poster_scale = 0.7
+        
+        # Special handling for specific device types
+        if "iPhone" in device_name or "Android" in device_name:
             # For mobile devices, make posters larger and reduce count
             poster_scale *= 1.3
             gap = int(8 * scale_factor)  # Slightly larger gap for mobile
         
-        poster_width = int(base_poster_width * poster_scale * scale_factor)
-        poster_height = int(base_poster_height * poster_scale * scale_factor)
-        
-        # Calculate how many posters we need to fill the rotated canvas
-        # We need to create a canvas larger than the final size to account for rotation
-        angle = -15  # Tilt angle
-        angle_rad = math.radians(abs(angle))
+        self.gap = gap
+        self.poster_width = int(base_poster_width * poster_scale * scale_factor)
+        self.poster_height = int(base_poster_height * poster_scale * scale_factor)
         
-        # Calculate the expanded dimensions needed to ensure full coverage after rotation
+        # The virtual grid canvas must cover the output at any rotation
         diagonal = math.sqrt(width**2 + height**2)
-        expanded_width = int(diagonal * 1.2)
-        expanded_height = int(diagonal * 1.2)
+        self.expanded_size = int(diagonal * 1.2)
         
         # Calculate grid dimensions based on expanded canvas
-        cols = (expanded_width // (poster_width + gap)) + 2
-        rows = (expanded_height // (poster_height + gap)) + 2
+        self.cols = (self.expanded_size // (self.poster_width + gap)) + 2
+        self.rows = (self.expanded_size // (self.poster_height + gap)) + 2
         
-        # Use cached posters (thread-safe access)
-        with self.cache_lock:
-            if not self.cached_posters:
-                print(f"Warning: No cached posters available for {device_name}")
-                return None
-            # Create a copy of cached posters for this thread
-            posters = [poster.copy() if poster else None for poster in self.cached_posters]
-        
-        # Create the grid canvas with black background
-        grid_canvas = Image.new('RGB', (expanded_width, expanded_height), (0, 0, 0))
-        
-        # Fill the entire canvas with posters, repeating if necessary
-        poster_index = 0
-        for row in range(rows):
-            for col in range(cols):
-                if poster_index >= len(posters):
-                    poster_index = 0  # Loop back to start
-                
-                # Calculate position
-                x = col * (poster_width + gap)
-                y = row * (poster_height + gap)
+        self._build_affine()
+    
+    def _build_affine(self):
+        """Compute the output -> grid mapping used by rotate(expand=True) + center crop"""
+        size = self.expanded_size
+        center = size / 2.0
+        
+        # Same matrix Pillow builds for Image.rotate
+        theta = -math.radians(self.angle)
+        cos_t = round(math.cos(theta), 15)
+        sin_t = round(math.sin(theta), 15)
+        
+        def transform(x, y, c=0.0, f=0.0):
+            return cos_t * x + sin_t * y + c, -sin_t * x + cos_t * y + f
+        
+        c, f = transform(-center, -center)
+        c += center
+        f += center
+        
+        # Size of the expanded rotated image
+        xs, ys = zip(*(transform(x, y, c, f) for x, y in ((0, 0), (size, 0), (size, size), (0, size))))
+        rotated_width = math.ceil(max(xs)) - math.floor(min(xs))
+        rotated_height = math.ceil(max(ys)) - math.floor(min(ys))
+        c, f = transform(-(rotated_width - size) / 2.0, -(rotated_height - size) / 2.0, c, f)
+        
+        # Fold the center crop into the translation
+        crop_x = (rotated_width - self.width) // 2
+        crop_y = (rotated_height - self.height) // 2
+        c, f = transform(crop_x, crop_y, c, f)
+        
+        self._cos = cos_t
+        self._sin = sin_t
+        self._offset = (c, f)
+    
+    def output_to_grid(self, x, y):
+        """Map an output pixel coordinate to grid canvas coordinates"""
+        c, f = self._offset
+        return self._cos * x + self._sin * y + c, -self._sin * x + self._cos * y + f
+    
+    def grid_to_output(self, x, y):
+        """Map a grid canvas coordinate to output pixel coordinates"""
+        c, f = self._offset
+        dx, dy = x - c, y - f
+        return self._cos * dx - self._sin * dy, self._sin * dx + self._cos * dy
+    
+    def affine_for(self, box, origin):
+        """Affine data mapping pixels of the output box into a region starting at origin"""
+        gx, gy = self.output_to_grid(box[0], box[1])
+        return (
+            self._cos, self._sin, gx - origin[0],
+            -self._sin, self._cos, gy - origin[1]
+        )
+    
+    def grid_bounds(self, box):
+        """Integer grid-canvas bounds needed to render an output box, or None if empty"""
+        x0, y0, x1, y1 = box
+        xs, ys = zip(*(self.output_to_grid(x, y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))))
+        margin = self.RESAMPLE_MARGIN
+        left = max(0, math.floor(min(xs)) - margin)
+        top = max(0, math.floor(min(ys)) - margin)
+        right = min(self.expanded_size, math.ceil(max(xs)) + margin)
+        bottom = min(self.expanded_size, math.ceil(max(ys)) + margin)
+        if right <= left or bottom <= top:
+            return None
+        return left, top, right, bottom
+    
+    def cell_origin(self, row, col):
+        """Top-left grid coordinate of a cell"""
+        return col * (self.poster_width + self.gap), row * (self.poster_height + self.gap)
+    
+    def render_signature(self):
+        """Everything that decides the rendered pixels; equal signatures render identically"""
+        return (self.width, self.height, self.poster_width, self.poster_height,
+                self.gap, self.angle, self.cols, self.rows)
+    
+    def can_derive_from(self, source):
+        """True if this grid is source's grid scaled down, so its image can be
+        made by downscaling source's render (geometry within a pixel, same posters
+        in the same cells)"""
+        if self.render_signature() == source.render_signature():
+            return True
+        if (self.cols, self.rows, self.angle) != (source.cols, source.rows, source.angle):
+            return False
+        if self.width >= source.width:
+            return False
+        scale = self.width / source.width
+        return all(abs(mine - theirs * scale) <= 1 for mine, theirs in (
+            (self.height, source.height),
+            (self.poster_width, source.poster_width),
+            (self.poster_height, source.poster_height),
+            (self.gap, source.gap),
+            (self.expanded_size, source.expanded_size),
+        ))
+    
+    def estimated_peak_bytes(self, strip_height=None, stacked_posters=0, encoder_copies=0):
+        """Rough peak memory of rendering and encoding this layout
+        
+        The composed grid region (RGB, 4 bytes per pixel in Pillow) and the
+        output canvas are alive during the rotate; the encoders then add
+        working buffers of about 13 bytes per output pixel (WebP converts to
+        ARGB/YUV, PNG and JPEG buffer rows and output). Calibrated against
+        benchmark.py peak RSS measurements.
+        
+        Rendered in strips (strip_height), the canvas lives in a file-backed map
+        and formats are encoded one after another, so the peak is a few strips
+        plus the largest encoder's buffers (libwebp holds the whole picture as
+        ARGB and YUV, about 8 bytes per pixel).
+        
+        The NumPy compositor (stacked_posters tiles in one array) also holds
+        the stack, and the composed region twice while it becomes an image.
+        Formats encoded concurrently each beyond the first read their own copy
+        of the canvas (encoder_copies, 4 bytes per pixel each).
+        """
+        stack = 3 * self.poster_width * self.poster_height * stacked_posters
+        if strip_height:
+            return stack + 12 * strip_height * self.width + 8 * self.width * self.height + 16 * 1024 * 1024
+        bounds = self.grid_bounds((0, 0, self.width, self.height))
+        composed = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]) if bounds else 0
+        composed_bytes = (7 if stacked_posters else 4) * composed
+        copies = 4 * encoder_copies * self.width * self.height
+        return stack + composed_bytes + copies + 16 * self.width * self.height + 16 * 1024 * 1024
+    
+    def poster_index(self, row, col, poster_count):
+        """Index of the poster shown in a cell (posters repeat row by row)"""
+        return (row * self.cols + col) % poster_count
+    
+    def cells_in(self, bounds, box=None):
+        """Yield (row, col) of cells overlapping grid bounds and the rotated output box"""
+        left, top, right, bottom = bounds
+        step_x = self.poster_width + self.gap
+        step_y = self.poster_height + self.gap
+        
+        if box is None:
+            box = (0, 0, self.width, self.height)
+        margin = self.RESAMPLE_MARGIN
+        
+        first_col = max(0, (left - self.poster_width) // step_x)
+        last_col = min(self.cols - 1, right // step_x)
+        first_row = max(0, (top - self.poster_height) // step_y)
+        last_row = min(self.rows - 1, bottom // step_y)
+        
+        for row in range(first_row, last_row + 1):
+            y = row * step_y
+            if y >= bottom or y + self.poster_height <= top:
+                continue
+            for col in range(first_col, last_col + 1):
+                x = col * step_x
+                if x >= right or x + self.poster_width <= left:
+                    continue
                 
-                # Skip if poster is None
-                if posters[poster_index] is None:
-                    poster_index += 1
+                # Separating-axis check against the output box edges
+                us, vs = zip(*(self.grid_to_output(cx, cy) for cx, cy in (
+                    (x, y),
+                    (x + self.poster_width, y),
+                    (x + self.poster_width, y + self.poster_height),
+                    (x, y + self.poster_height)
+                )))
+                if (max(us) < box[0] - margin or min(us) > box[2] + margin or
+                        max(vs) < box[1] - margin or min(vs) > box[3] + margin):
                     continue
-                    
-                # Resize poster to current dimensions
-                try:
-                    resized_poster = posters[poster_index].resize(
-                        (poster_width, poster_height), 
-                        Image.LANCZOS
-                    )
-                except Exception as e:
-                    print(f"Error resizing poster {poster_index}: {e}")
-                    poster_index += 1
+                yield row, col
+
+
+class WallpaperVariant:
+    """One randomized wallpaper of a batch: which posters, in what order, at what tilt
+    
+    Built from random.Random(f"{seed}:{index}") over the poster pool, so the
+    same seed and pool always give the same variants.
+    """
+    
+    def __init__(self, seed, index, poster_ids, angle, genre=None):
+        self.seed = str(seed)
+        self.index = index
+        self.poster_ids = list(poster_ids)
+        self.angle = angle
+        self.genre = genre  # TMDB genre id the posters were filtered by, if any
+    
+    @property
+    def key_prefix(self):
+        """Where the batch's outputs are stored, ahead of the usual format/ directories"""
+        return f"variants/{self.seed.replace('/', '-')}/"
+    
+    def output_name(self, device_name):
+        return f"{device_name}_{self.index:02d}"
+    
+    def describe(self):
+        return {
+            'index': self.index,
+            'angle': self.angle,
+            'genre': self.genre,
+            'posters': self.poster_ids,
+        }
+
+
+class TMDBPosterGenerator:
+    RESULTS_PER_PAGE = 20  # TMDB list endpoints return 20 results per page
+    # TMDB poster sizes, smallest first ('original' has no fixed width)
+    POSTER_SIZES = [('w185', 185), ('w342', 342), ('w500', 500), ('w780', 780), ('original', None)]
+    POSTER_ASPECT = 2 / 3  # TMDB posters are 2:3 (width / height)
+    OUTPUT_FORMATS = ('original', 'jpeg', 'webp')
+    POSTERS_PER_WALLPAPER = 40
+    # zlib strategies for the PNG master (PNG_STRATEGY)
+    PNG_STRATEGIES = {
+        'default': zlib.Z_DEFAULT_STRATEGY,
+        'filtered': zlib.Z_FILTERED,
+        'huffman': zlib.Z_HUFFMAN_ONLY,
+        'rle': zlib.Z_RLE,
+        'fixed': zlib.Z_FIXED,
+    }
+    BATCH_MIN_GENRE_POSTERS = 12  # Fewer matching posters: the variant uses the whole pool
+    
+    def __init__(self, api_key, sink=None, output_formats=None, plan_only=False):
+        # plan_only: settings for plan_run alone; no caches, pools or manifest are set up
+        self.api_key = api_key
+        self.base_url = "https://api.themoviedb.org/3"
+        self.image_cdn_url = "https://image.tmdb.org/t/p"
+        self.decode_size = None  # Largest tile any device needs (set by plan_image_size)
+        self.set_image_size("w500")
+        self.poster_pool = PosterPool()  # Decoded posters shared by every render
+        self.poster_genres = {}  # TMDB poster_path -> genre ids, for batch genre filters
+        self.tile_cache = TileCache()  # Resized tiles shared across devices
+        # Downloaded posters kept across runs
+        self.poster_cache = PosterDiskCache(cache_dir='') if plan_only else PosterDiskCache()
+        self.tmdb = TMDBClient()  # Pooled HTTP session with retries
+        # Size-targeted JPEG quality search
+        self.jpeg_model = JpegQualityModel(history_path='') if plan_only else JpegQualityModel()
+        
+        # Encode stage: formats are encoded concurrently from the rendered pixels
+        self.png_compress_level = int(os.getenv('PNG_COMPRESS_LEVEL', '6'))
+        self.png_strategy = os.getenv('PNG_STRATEGY', 'default').lower()
+        if self.png_strategy not in self.PNG_STRATEGIES:
+            print(f"Warning: Unknown PNG_STRATEGY '{self.png_strategy}', using default")
+            self.png_strategy = 'default'
+        # Large PNG masters are deflated in strips on several threads
+        self.png_threads = max(1, int(os.getenv('PNG_THREADS') or multiprocessing.cpu_count()))
+        self.png_parallel_min_pixels = int(os.getenv('PNG_PARALLEL_MIN_PIXELS', '4000000'))
+        # The lossless master: "png", "webp" (lossless WebP) or "none" (not produced)
+        self.master_format = os.getenv('MASTER_FORMAT', 'png').lower()
+        self.master_webp_method = int(os.getenv('MASTER_WEBP_METHOD', '4'))
+        self.master_webp_quality = int(os.getenv('MASTER_WEBP_QUALITY', '50'))
+        # Grid composition: "numpy" lays out all cells in a few array operations
+        # (NumPy itself is imported by the first compose)
+        compositor = os.getenv('COMPOSITOR', 'auto').lower()
+        numpy_available = compositor in ('auto', 'numpy') and _numpy_installed()
+        if compositor == 'numpy' and not numpy_available:
+            print("Warning: COMPOSITOR=numpy but NumPy is not installed, using Pillow")
+        self.compositor = 'numpy' if numpy_available else 'pillow'
+        # Outputs this large are rendered in strips instead of as one canvas
+        self.stream_min_pixels = int(os.getenv('STREAM_MIN_PIXELS', '16000000'))
+        self.strip_height = max(16, int(os.getenv('STREAM_STRIP_HEIGHT', '256')))
+        self.webp_method = int(os.getenv('WEBP_METHOD', '6'))
+        # Where outputs go: "s3", "local" (./backgrounds) or "none" (encode only)
+        if sink is None:
+            sink = 's3' if os.getenv('S3_ENABLED', 'false').lower() == 'true' else 'local'
+        self.sink = sink
+        self.output_formats = tuple(
+            format_name for format_name in (output_formats or self.OUTPUT_FORMATS)
+            if format_name != 'original' or self.master_format != 'none'
+        )
+        if os.getenv('ENCODE_WORKERS'):
+            encode_workers = max(1, int(os.getenv('ENCODE_WORKERS')))
+        else:
+            # Every render worker can be encoding all of its formats at once
+            render_workers = int(os.getenv('RENDER_WORKERS') or multiprocessing.cpu_count())
+            encode_workers = max(1, render_workers) * max(1, len(self.output_formats))
+        self.encoder_pool = None if plan_only else ThreadPoolExecutor(
+            max_workers=encode_workers, thread_name_prefix='encode'
+        )
+        self.s3_storage = S3Storage(enabled=sink == 's3' and not plan_only)  # Initialize S3 storage
+        self.upload_queue = UploadQueue(self.s3_storage) if self.s3_storage.enabled else None
+        # Loaded by create_all_device_sizes
+        self.manifest = None if plan_only else RenderManifest(self.s3_storage)
+        self.metrics = RunMetrics()  # Stage timings and counters for this run
+        
+    def fetch_popular_content(self, count=12):
+        """Fetch a mix of popular movies and TV series from TMDB"""
+        # Calculate how many of each type to fetch
+        movies_count = count // 2
+        tv_count = count - movies_count
+        
+        # Fetch popular movies and TV shows from multiple pages concurrently
+        print("Fetching movies and TV series...")
+        results = self._fetch_popular_pages([('movie', movies_count), ('tv', tv_count)])
+        content = results['movie']
+        tv_content = results['tv']
+        
+        # Mix movies and TV shows
+        content = content[:movies_count] + tv_content[:tv_count]
+        
+        # Shuffle for variety. The order only changes when the popular lists do,
+        # so incremental runs can skip devices whose inputs are unchanged.
+        seed = ','.join(sorted(f"{item.get('id')}:{item.get('poster_path')}" for item in content))
+        random.Random(seed).shuffle(content)
+        
+        print(f"Fetched {len(content)} items ({movies_count} movies, {tv_count} TV series)")
+        return content[:count]
+    
+    def _fetch_popular_pages(self, wanted, max_pages=3):
+        """Fetch enough popular-list pages for each (media type, count), in parallel"""
+        pages = {media_type: {} for media_type, _ in wanted}
+        next_page = {media_type: 1 for media_type, _ in wanted}
+        
+        def fetch_page(task):
+            media_type, page = task
+            url = f"{self.base_url}/{media_type}/popular?api_key={self.api_key}&page={page}"
+            try:
+                response = self.tmdb.get(url)
+                if response.status_code == 200:
+                    return media_type, page, response.json()['results']
+                print(f"Error fetching {media_type} page {page}: HTTP {response.status_code}")
+            except Exception as e:
+                print(f"Error fetching {media_type} page {page}: {e}")
+            return media_type, page, None
+        
+        # Request the pages expected to be enough, then more if any came back short
+        while True:
+            tasks = []
+            for media_type, needed in wanted:
+                missing = needed - sum(len(items) for items in pages[media_type].values())
+                first_page = next_page[media_type]
+                if missing <= 0 or first_page > max_pages:
                     continue
-                
-                # Paste the poster directly without shadow
-                grid_canvas.paste(resized_poster, (x, y))
-                poster_index += 1
-        
-        # Rotate the entire grid
-        rotated_grid = grid_canvas.rotate(angle, expand=True, fillcolor=(0, 0, 0), resample=Image.BICUBIC)
-        
-        # Calculate center crop to get final dimensions
-        rotated_width, rotated_height = rotated_grid.size
-        crop_x = (rotated_width - width) // 2
-        crop_y = (rotated_height - height) // 2
-        
-        # Crop to final size
-        final_canvas = rotated_grid.crop((
-            crop_x, 
-            crop_y, 
-            crop_x + width, 
-            crop_y + height
-        ))
+                last_page = min(max_pages, first_page + math.ceil(missing / self.RESULTS_PER_PAGE) - 1)
+                tasks.extend((media_type, page) for page in range(first_page, last_page + 1))
+                next_page[media_type] = last_page + 1
+            
+            if not tasks:
+                break
+            for media_type, page, items in self.tmdb.map(fetch_page, tasks):
+                if items:
+                    pages[media_type][page] = items
         
-        # No vignette effect - keep clean poster grid
+        return {
+            media_type: [item for page in sorted(media_pages) for item in media_pages[page]]
+            for media_type, media_pages in pages.items()
+        }
+    
+    def plan_image_size(self, devices):
+        """Pick the smallest TMDB poster size that covers every device's tiles"""
+        layouts = [GridLayout(*device_info) for device_info in devices]
+        tile_size = (
+            max(layout.poster_width for layout in layouts),
+            max(layout.poster_height for layout in layouts)
+        )
         
-        # Only create temp directories if S3 is disabled (for local storage)
-        if not self.s3_storage.enabled:
-            base_dir = './backgrounds'
-            os.makedirs(f'{base_dir}/original', exist_ok=True)
-            os.makedirs(f'{base_dir}/webp', exist_ok=True)
-            os.makedirs(f'{base_dir}/jpeg', exist_ok=True)
-        else:
-            # Use temp directory for S3-only mode
-            import tempfile
-            base_dir = tempfile.mkdtemp()
+        size_name = self.poster_size_for(tile_size)
+        self.set_image_size(size_name, tile_size)
+        print(f"Using TMDB poster size {size_name} (largest tile {tile_size[0]}x{tile_size[1]})")
+        return size_name
+    
+    def poster_size_for(self, tile_size):
+        """Smallest TMDB poster size covering a tile (or TMDB_IMAGE_SIZE if set)"""
+        size_name = os.getenv('TMDB_IMAGE_SIZE', 'auto')
+        if size_name != 'auto':
+            return size_name
+        needed_width = max(tile_size[0], math.ceil(tile_size[1] * self.POSTER_ASPECT))
+        return next(name for name, width in self.POSTER_SIZES if width is None or width >= needed_width)
+    
+    def set_image_size(self, size_name, decode_size=None):
+        """Download posters at a TMDB size, optionally decoding them down to decode_size"""
+        self.image_size = size_name
+        self.image_base_url = f"{self.image_cdn_url}/{size_name}"
+        self.decode_size = tuple(decode_size) if decode_size else None
+    
+    def decode_poster(self, data):
+        """Decode poster bytes, no larger than needed for the biggest tile"""
+        poster = Image.open(io.BytesIO(data))
+        if self.decode_size:
+            # libjpeg can decode at 1/2, 1/4 or 1/8 scale directly; the result
+            # stays at least as large as decode_size
+            poster.draft(None, self.decode_size)
+        # Decode once here so render threads can share it read-only
+        poster.load()
+        if self.decode_size:
+            factor = min(poster.width // self.decode_size[0], poster.height // self.decode_size[1])
+            if factor >= 2:
+                poster = poster.reduce(factor)
+        return self.normalize_poster(poster)
+    
+    def normalize_poster(self, poster):
+        """Convert a decoded poster to plain sRGB RGB, once, so pastes never convert
         
-        filename_base = device_name.lower().replace(' ', '_')
+        Embedded colour profiles (CMYK and wide-gamut posters) are applied,
+        transparency is flattened onto black like the grid background, and any
+        other mode is converted.
+        """
+        icc_profile = poster.info.get('icc_profile')
+        if poster.mode not in ('RGB', 'L', 'CMYK'):
+            if 'A' in poster.getbands() or 'transparency' in poster.info:
+                rgba = poster.convert('RGBA')
+                poster = Image.new('RGB', rgba.size)
+                poster.paste(rgba, mask=rgba.getchannel('A'))
+            else:
+                poster = poster.convert('RGB')
         
-        # Save original PNG to temp location
-        if not self.s3_storage.enabled:
-            original_path = f"{base_dir}/original/{filename_base}.png"
+        if icc_profile and ImageCms is not None:
+            try:
+                profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+                if 'sRGB' not in ImageCms.getProfileDescription(profile):
+                    poster = ImageCms.profileToProfile(poster, profile, _srgb_profile(), outputMode='RGB')
+            except (ImageCms.PyCMSError, OSError, ValueError) as e:
+                print(f"Warning: Ignoring unusable colour profile: {e}")
+        
+        if poster.mode != 'RGB':
+            poster = poster.convert('RGB')
+        poster.info.pop('icc_profile', None)
+        return poster
+    
+    def fetch_poster_data(self, poster_path):
+        """Poster bytes from TMDB, revalidating the disk cache; None if unavailable"""
+        if not poster_path:
+            return None
+        
+        full_url = f"{self.image_base_url}{poster_path}"
+        cached_data, cached_meta = self.poster_cache.load(poster_path, self.image_size)
+        data = None
+        try:
+            # Revalidate a cached copy instead of downloading it again
+            response = self.tmdb.get(full_url, headers=self.poster_cache.validators(cached_meta))
+            if response.status_code == 304 and cached_data is not None:
+                self.poster_cache.touch(poster_path, self.image_size)
+                data = cached_data
+            elif response.status_code == 200:
+                data = response.content
+                self.poster_cache.store(poster_path, self.image_size, data, response.headers)
+        except Exception as e:
+            print(f"Error downloading poster: {e}")
+        
+        if data is None:
+            # Fall back to a cached copy when TMDB is unreachable
+            data = cached_data
+        return data
+    
+    def download_poster(self, poster_path):
+        """Download a poster and decode it; returns (poster, sha256 of its bytes) or None"""
+        data = self.fetch_poster_data(poster_path)
+        if data is None:
+            return None
+        try:
+            poster = self.decode_poster(data)
+        except Exception as e:
+            # Truncated or corrupt files are dropped here, before any render sees them
+            print(f"Error decoding poster {poster_path}: {e}")
+            return None
+        if not poster.width or not poster.height:
+            return None
+        return poster, hashlib.sha256(data).hexdigest()
+    
+    def fetch_poster_list(self, count=POSTERS_PER_WALLPAPER):
+        """Pick the content to show; returns [(poster_path, title), ...] in grid order"""
+        print("\nFetching diverse content from TMDB (one-time fetch)...")
+        content = self.fetch_popular_content(count=count)
+        
+        # Prepare download tasks
+        download_tasks = []
+        for item in content:
+            poster_path = item.get('poster_path')
+            if poster_path:
+                title = item.get('title') or item.get('name', 'Unknown')
+                download_tasks.append((poster_path, title))
+                self.poster_genres[poster_path] = item.get('genre_ids') or []
+        return download_tasks
+    
+    def fetch_and_cache_posters(self, count=40, download_tasks=None, refresh=False):
+        """Fetch posters once into the shared pool with parallel downloads; returns the pool"""
+        if self.poster_pool and not refresh:
+            return self.poster_pool
+        
+        if download_tasks is None:
+            download_tasks = self.fetch_poster_list(count=count)
+        
+        print(f"\nDownloading {len(download_tasks)} posters ({self.tmdb.concurrency} concurrent downloads)...")
+        
+        # Download posters in parallel over the pooled TMDB session
+        downloaded_count = 0
+        lock = threading.Lock()
+        
+        def download_with_progress(task_data):
+            poster_path, title = task_data
+            downloaded = self.download_poster(poster_path)
+            if downloaded:
+                with lock:
+                    nonlocal downloaded_count
+                    downloaded_count += 1
+                    print(f"[{downloaded_count}/{len(download_tasks)}] Downloaded: {title}")
+                return (poster_path,) + downloaded
+            return None
+        
+        poster_ids = []
+        posters = []
+        digests = []
+        duplicates = 0
+        with ThreadPoolExecutor(max_workers=self.tmdb.concurrency) as executor:
+            # Keep the planned order regardless of which download finishes first
+            for result in executor.map(download_with_progress, download_tasks):
+                if not result:
+                    continue
+                poster_path, poster, digest = result
+                if digest in digests:
+                    duplicates += 1  # Same image under another title: show it once
+                    continue
+                poster_ids.append(poster_path)
+                posters.append(poster)
+                digests.append(digest)
+        
+        # Swap in the new set at once; renders already running keep the pool they read
+        self.poster_pool = PosterPool(poster_ids, posters, digests,
+                                      [poster_path for poster_path, _ in download_tasks])
+        
+        print(f"\nCached {len(self.poster_pool)} posters for reuse "
+              f"({self.poster_pool.nbytes / (1024 * 1024):.1f}MB decoded"
+              f"{f', {duplicates} duplicates dropped' if duplicates else ''})")
+        if self.poster_cache.enabled:
+            evicted = self.poster_cache.evict()
+            print(f"Poster disk cache: {self.poster_cache.revalidated} revalidated, "
+                  f"{self.poster_cache.downloaded} downloaded, {evicted} evicted")
+        return self.poster_pool
+    
+    def compose_grid_region(self, layout, tiles, bounds, box=None):
+        """Paste the grid cells that reach the output box into a canvas covering bounds"""
+        if self.compositor == 'numpy':
+            _import_numpy()
+            if not isinstance(tiles, np.ndarray):
+                tiles = self.stack_tiles(layout, tiles)
+            return self._compose_grid_region_numpy(layout, tiles, bounds)
+        
+        left, top, right, bottom = bounds
+        canvas = Image.new('RGB', (right - left, bottom - top), (0, 0, 0))
+        
+        for row, col in layout.cells_in(bounds, box):
+            tile = tiles[layout.poster_index(row, col, len(tiles))]
+            # Skip if poster is None or failed to resize
+            if tile is None:
+                continue
+            x, y = layout.cell_origin(row, col)
+            canvas.paste(tile, (x - left, y - top))
+        
+        return canvas
+    
+    def stack_tiles(self, layout, tiles):
+        """Tiles as one (count, height, width, 3) array; missing tiles are black"""
+        _import_numpy()
+        stack = np.zeros((len(tiles), layout.poster_height, layout.poster_width, 3), dtype=np.uint8)
+        for index, tile in enumerate(tiles):
+            if tile is not None:
+                stack[index] = np.asarray(tile if tile.mode == 'RGB' else tile.convert('RGB'))
+        return stack
+    
+    def _compose_grid_region_numpy(self, layout, stack, bounds):
+        """Lay out every cell overlapping bounds with one array assignment per grid row
+        
+        Cells outside the output footprint are drawn too; the rotate never
+        samples them, so the result matches the Pillow path pixel for pixel.
+        """
+        left, top, right, bottom = bounds
+        cell_width = layout.poster_width + layout.gap
+        cell_height = layout.poster_height + layout.gap
+        first_row, last_row = top // cell_height, (bottom - 1) // cell_height
+        first_col, last_col = left // cell_width, (right - 1) // cell_width
+        row_count = last_row - first_row + 1
+        col_count = last_col - first_col + 1
+        
+        # Same assignment as GridLayout.poster_index, for the whole block of cells
+        rows = np.arange(first_row, last_row + 1)[:, None]
+        cols = np.arange(first_col, last_col + 1)[None, :]
+        poster_indexes = (rows * layout.cols + cols) % len(stack)
+        
+        # One grid row of cells as (y, col, x, channel), so a reshape turns it into
+        # an image band; gaps stay black. Bands are copied straight into the region.
+        band = np.zeros((cell_height, col_count, cell_width, 3), dtype=np.uint8)
+        band_image = band.reshape(cell_height, col_count * cell_width, 3)
+        region = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+        x = left - first_col * cell_width
+        for row in range(row_count):
+            band[:layout.poster_height, :, :layout.poster_width] = stack[poster_indexes[row]].transpose(1, 0, 2, 3)
+            band_top = (first_row + row) * cell_height - top
+            start, end = max(0, band_top), min(bottom - top, band_top + cell_height)
+            region[start:end] = band_image[start - band_top:end - band_top, x:x + right - left]
+        return Image.fromarray(region)
+    
+    def rotate_grid_region(self, layout, canvas, bounds, box):
+        """Resample a composed grid region into the output box with one affine transform"""
+        left, top = bounds[:2]
+        return canvas.transform(
+            (box[2] - box[0], box[3] - box[1]),
+            Image.AFFINE,
+            layout.affine_for(box, (left, top)),
+            resample=Image.BICUBIC,
+            fillcolor=(0, 0, 0)
+        )
+    
+    def render_grid(self, layout, tiles, box=None, timings=None):
+        """Render the output box (default: whole image) of a tilted grid wallpaper"""
+        if box is None:
+            box = (0, 0, layout.width, layout.height)
+        
+        bounds = layout.grid_bounds(box)
+        if bounds is None:
+            return Image.new('RGB', (box[2] - box[0], box[3] - box[1]), (0, 0, 0))
+        
+        started = time.perf_counter()
+        canvas = self.compose_grid_region(layout, tiles, bounds, box)
+        composed = time.perf_counter()
+        output = self.rotate_grid_region(layout, canvas, bounds, box)
+        if timings is not None:
+            timings['compose'] = timings.get('compose', 0.0) + composed - started
+            timings['rotate'] = timings.get('rotate', 0.0) + time.perf_counter() - composed
+        return output
+    
+    def layout_for(self, device_info, variant=None):
+        """GridLayout for a device, tilted and named for a batch variant if given"""
+        if variant is None:
+            return GridLayout(*device_info)
+        layout = GridLayout(*device_info, angle=variant.angle)
+        layout.variant = variant
+        layout.output_name = variant.output_name(layout.device_name)
+        return layout
+    
+    def render_wallpaper(self, device_name, width, height, scale_factor=1, variant=None):
+        """Render a tilted poster grid; returns (layout, canvas) or None"""
+        layout = self.layout_for((device_name, width, height, scale_factor), variant)
+        width, height = layout.width, layout.height
+        
+        print(f"\nCreating {device_name} wallpaper ({width}x{height} @ {scale_factor}x)...")
+        
+        # Posters are decoded RGB and only read, so every render shares the pool
+        pool = self.poster_pool
+        if not pool:
+            print(f"Warning: No cached posters available for {device_name}")
+            return None
+        poster_ids, posters = pool.poster_ids, pool.posters
+        if variant is not None:
+            # A variant picks its posters from the pool by id
+            poster_ids, posters = pool.select(variant.poster_ids)
+        
+        # Resize each poster once; devices sharing a tile size reuse the same tiles
+        started = time.perf_counter()
+        tiles = []
+        for poster_index, poster in enumerate(posters):
+            if poster is None:
+                tiles.append(None)
+                continue
+            try:
+                tiles.append(self.tile_cache.get_tile(
+                    poster_ids[poster_index],
+                    poster,
+                    (layout.poster_width, layout.poster_height)
+                ))
+            except Exception as e:
+                print(f"Error resizing poster {poster_index}: {e}")
+                tiles.append(None)
+        layout.timings['resize'] = time.perf_counter() - started
+        
+        if self.compositor == 'numpy':
+            tiles = self.stack_tiles(layout, tiles)  # Stacked once, reused by every strip
+        
+        # Draw only the part of the tilted grid that lands in the output
+        if self.streams(layout):
+            final_canvas = self.render_strips(layout, tiles)
         else:
-            original_path = f"{base_dir}/{filename_base}_original.png"
+            final_canvas = self.render_grid(layout, tiles, timings=layout.timings)
+        layout.poster_ids = poster_ids
+        layout.planned_ids = pool.planned_ids if variant is None else variant.poster_ids
         
-        final_canvas.save(original_path, 'PNG', quality=95, optimize=False)
-        original_size = os.path.getsize(original_path) / (1024 * 1024)  # MB
+        # No vignette effect - keep clean poster grid
+        return layout, final_canvas
+    
+    def streams(self, layout):
+        """True if the layout is rendered strip by strip"""
+        return layout.width * layout.height >= self.stream_min_pixels
+    
+    def render_strips(self, layout, tiles):
+        """Render the output in horizontal strips into a file-backed RGBX canvas
+        
+        Each strip is drawn block by block straight from the grid geometry, so
+        only a strip's worth of pixels is ever held in memory. The returned
+        image reads from an unlinked temp file mapped into memory, which the
+        kernel can page out; PNG encodes it strip by strip as well.
+        """
+        width, height = layout.width, layout.height
+        row_bytes = width * 4
+        with tempfile.TemporaryFile(dir=os.getenv('STREAM_TEMP_DIR') or None) as f:
+            f.truncate(row_bytes * height)
+            buffer = mmap.mmap(f.fileno(), row_bytes * height)
         
-        # Determine target file size based on resolution
+        # Blocks keep each composed grid region small: a full-width strip of a
+        # tilted grid would need a region about width * sin(angle) tall
+        block_width = self.strip_height * 4
+        for top in range(0, height, self.strip_height):
+            bottom = min(height, top + self.strip_height)
+            strip = Image.new('RGB', (width, bottom - top))
+            for left in range(0, width, block_width):
+                right = min(width, left + block_width)
+                block = self.render_grid(layout, tiles, (left, top, right, bottom), timings=layout.timings)
+                strip.paste(block, (left, 0))
+            buffer[top * row_bytes:bottom * row_bytes] = strip.tobytes('raw', 'RGBX')
+        
+        print(f"Rendered {layout.device_name} in {math.ceil(height / self.strip_height)} strips")
+        return Image.frombuffer('RGBX', (width, height), buffer, 'raw', 'RGBX', 0, 1)
+    
+    def plan_render_groups(self, devices):
+        """Group devices that can share one render; the first device of each group is rendered
+        
+        RENDER_SHARING=scaled (default) groups devices whose grid is a scaled-down
+        copy of a larger one, exact only groups identical renders, off renders
+        every device separately.
+        """
+        sharing = os.getenv('RENDER_SHARING', 'scaled').lower()
+        layouts = {device_info: GridLayout(*device_info) for device_info in devices}
+        groups = []  # (source layout, [device_info, ...])
+        for device_info in sorted(devices, key=lambda info: layouts[info].width * layouts[info].height,
+                                  reverse=True):
+            layout = layouts[device_info]
+            for source, members in groups:
+                if sharing == 'exact' and layout.render_signature() == source.render_signature():
+                    members.append(device_info)
+                    break
+                if sharing == 'scaled' and layout.can_derive_from(source):
+                    members.append(device_info)
+                    break
+            else:
+                groups.append((layout, [device_info]))
+        
+        for source, members in groups:
+            if len(members) > 1:
+                print(f"Rendering {source.device_name} once for {', '.join(info[0] for info in members[1:])}")
+        return [tuple(members) for _, members in groups]
+    
+    def render_group(self, group, variant=None):
+        """Render a group's first device, then derive the others from its canvas; yields (layout, canvas)"""
+        rendered = self.render_wallpaper(*group[0], variant=variant)
+        if rendered is None:
+            return
+        source_layout, source_canvas = rendered
+        yield rendered
+        
+        canvases = {source_canvas.size: source_canvas}  # Devices of the same size share one canvas
+        for device_info in group[1:]:
+            started = time.perf_counter()
+            layout = self.layout_for(device_info, variant)
+            size = (layout.width, layout.height)
+            if size not in canvases:
+                canvases[size] = self.derive_canvas(source_canvas, size)
+            canvas = canvases[size]
+            layout.poster_ids = source_layout.poster_ids
+            layout.planned_ids = source_layout.planned_ids
+            layout.timings['derive'] = time.perf_counter() - started
+            print(f"\nDerived {layout.device_name} wallpaper ({layout.width}x{layout.height}) "
+                  f"from {source_layout.device_name}")
+            yield layout, canvas
+    
+    def derive_canvas(self, canvas, size):
+        """Reuse a rendered canvas for another device, downscaling it if needed"""
+        size = tuple(size)
+        if canvas.size == size:
+            return canvas  # Encoders never modify the canvas, so it can be shared
+        # reducing_gap: box-reduce by an integer factor first, then Lanczos the rest
+        return canvas.resize(size, Image.LANCZOS, reducing_gap=2.0)
+    
+    def produce_group(self, group, variant=None):
+        """Render, encode and store a group of devices; returns their manifest results"""
+        results = []
+        try:
+            for layout, canvas in self.render_group(group, variant):
+                try:
+                    results.append(self.finish_wallpaper(layout, canvas))
+                except Exception as e:
+                    _report_device_error(layout.device_name, e)
+        except Exception as e:
+            _report_device_error(group[0][0], e)
+        return results
+    
+    def render_inputs_hash(self, layout, poster_ids):
+        """Hash of everything that determines a device's output files"""
+        inputs = {
+            'render_version': RENDER_VERSION,
+            'posters': list(poster_ids),
+            'device': [layout.device_name, layout.width, layout.height, layout.scale_factor],
+            # What this device's tiles need, not the run-wide size picked for the
+            # largest device, so runs over different device subsets agree
+            'source': self.poster_size_for((layout.poster_width, layout.poster_height)),
+            'grid': [layout.poster_width, layout.poster_height, layout.gap, layout.angle],
+            'encode': {
+                'formats': list(self.output_formats),
+                'master': [self.master_format, self.png_compress_level, self.png_strategy,
+                           self.master_webp_method, self.master_webp_quality],
+                'jpeg_optimize': self.jpeg_model.optimize,
+                'jpeg_target_kb': self.target_size_kb(layout.width, layout.height),
+                'webp_method': self.webp_method,
+            },
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+    
+    def target_size_kb(self, width, height):
+        """JPEG size budget for a resolution"""
         total_pixels = width * height
-        if total_pixels > 8000000:  # 4K and above
-            target_size_kb = 2000  # 2MB
+        if total_pixels > 20000000:  # 8K
+            return 4000  # 4MB
+        elif total_pixels > 8000000:  # 4K and above
+            return 2000  # 2MB
         elif total_pixels > 4000000:  # QHD
-            target_size_kb = 1400  # 1.4MB
+            return 1400  # 1.4MB
         elif total_pixels > 2000000:  # FHD
-            target_size_kb = 1000  # 1MB
+            return 1000  # 1MB
         elif total_pixels > 1000000:  # HD/Tablets
-            target_size_kb = 800   # 800KB
+            return 800   # 800KB
         else:  # Mobile devices
-            target_size_kb = 500   # 500KB
-        
-        # Save JPEG with optimal quality for target size first
-        if not self.s3_storage.enabled:
-            jpeg_path = f"{base_dir}/jpeg/{filename_base}.jpg"
+            return 500   # 500KB
+    
+    def _encode_master(self, canvas):
+        """Lossless master of the rendered canvas in MASTER_FORMAT"""
+        if self.master_format == 'webp':
+            buffer = io.BytesIO()
+            canvas.save(buffer, 'WebP', lossless=True, quality=self.master_webp_quality,
+                        method=self.master_webp_method)
+            return {
+                'data': buffer.getvalue(),
+                'extension': '.webp',
+                'content_type': 'image/webp',
+            }
+        return self._encode_png(canvas)
+    
+    def _encode_png(self, canvas):
+        width, height = canvas.size
+        if canvas.mode == 'RGBX' or (self.png_threads > 1 and width * height >= self.png_parallel_min_pixels):
+            data = self._encode_png_strips(canvas)
         else:
-            jpeg_path = f"{base_dir}/{filename_base}.jpg"
-        jpeg_quality = 95
+            buffer = io.BytesIO()
+            canvas.save(buffer, 'PNG', compress_level=self.png_compress_level,
+                        compress_type=self.PNG_STRATEGIES[self.png_strategy])
+            data = buffer.getvalue()
+        return {
+            'data': data,
+            'extension': '.png',
+            'content_type': 'image/png',
+        }
+    
+    def _filtered_rows(self, canvas, top, bottom):
+        """PNG scanlines for rows top..bottom, each with the Sub filter
         
-        # Binary search for optimal JPEG quality
-        min_quality = 50
-        max_quality = 95
+        Sub stores each byte minus the same channel of the pixel to its left,
+        computed by ImageChops in C. Files come out within a few percent of
+        Pillow's adaptive filtering.
+        """
+        width = canvas.width
+        row_bytes = width * 3
+        strip = canvas.crop((0, top, width, bottom)).convert('RGB')
+        left_neighbours = Image.new('RGB', strip.size)
+        left_neighbours.paste(strip.crop((0, 0, width - 1, strip.height)), (1, 0))
+        filtered = ImageChops.subtract_modulo(strip, left_neighbours).tobytes()
+        return b''.join(
+            b'\x01' + filtered[offset:offset + row_bytes] for offset in range(0, len(filtered), row_bytes)
+        )
+    
+    def _encode_png_strips(self, canvas):
+        """RGB PNG filtered and deflated a strip at a time, on PNG_THREADS threads
         
-        while max_quality - min_quality > 5:
-            test_quality = (min_quality + max_quality) // 2
-            final_canvas.save(jpeg_path, 'JPEG', quality=test_quality, optimize=True)
-            test_size_kb = os.path.getsize(jpeg_path) / 1024
-            
-            if test_size_kb > target_size_kb:
-                max_quality = test_quality
-            else:
-                min_quality = test_quality
-                jpeg_quality = test_quality
+        With several threads each strip is deflated on its own, primed with
+        the last 32KB of the strip above as dictionary, and ended on a byte
+        boundary (Z_SYNC_FLUSH), so the pieces join into one zlib stream
+        (the approach pigz takes). Only a few strips are in flight at once.
+        """
+        width, height = canvas.size
+        strategy = self.PNG_STRATEGIES[self.png_strategy]
         
-        # Final save with optimal quality
-        final_canvas.save(jpeg_path, 'JPEG', quality=jpeg_quality, optimize=True)
-        jpeg_size_kb = os.path.getsize(jpeg_path) / 1024
+        def chunk(chunk_type, data):
+            return (struct.pack('>I', len(data)) + chunk_type + data +
+                    struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
         
-        # Save WebP version from JPEG for better optimization
-        if not self.s3_storage.enabled:
-            webp_path = f"{base_dir}/webp/{filename_base}.webp"
-        else:
-            webp_path = f"{base_dir}/{filename_base}.webp"
-        # Open the optimized JPEG and convert to WebP
-        with Image.open(jpeg_path) as jpeg_img:
-            webp_quality = 90 if target_size_kb > 1000 else 85
-            jpeg_img.save(webp_path, 'WebP', quality=webp_quality, method=6)
-        webp_size_kb = os.path.getsize(webp_path) / 1024
+        output = io.BytesIO()
+        output.write(b'\x89PNG\r\n\x1a\n')
+        output.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        tops = range(0, height, self.strip_height)
+        
+        if self.png_threads == 1:
+            compressor = zlib.compressobj(self.png_compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+            for top in tops:
+                data = compressor.compress(self._filtered_rows(canvas, top, min(height, top + self.strip_height)))
+                if data:
+                    output.write(chunk(b'IDAT', data))
+            output.write(chunk(b'IDAT', compressor.flush()))
+            output.write(chunk(b'IEND', b''))
+            return output.getvalue()
+        
+        # Rows overlapping the previous strip, enough to cover the 32KB deflate window
+        context_rows = math.ceil(32768 / (width * 3 + 1))
+        
+        def deflate_strip(top):
+            bottom = min(height, top + self.strip_height)
+            context_top = max(0, top - context_rows)
+            rows = self._filtered_rows(canvas, context_top, bottom)
+            split = (top - context_top) * (width * 3 + 1)
+            dictionary, rows = rows[:split], rows[split:]
+            compressor = zlib.compressobj(self.png_compress_level, zlib.DEFLATED, -zlib.MAX_WBITS, 8, strategy,
+                                          **({'zdict': dictionary[-32768:]} if dictionary else {}))
+            data = compressor.compress(rows)
+            data += compressor.flush(zlib.Z_FINISH if bottom == height else zlib.Z_SYNC_FLUSH)
+            return data, zlib.adler32(rows), len(rows)
+        
+        # zlib header: deflate, 32KB window, no preset dictionary for the stream itself
+        output.write(chunk(b'IDAT', b'\x78\x9c'))
+        checksum = 1
+        with ThreadPoolExecutor(max_workers=self.png_threads, thread_name_prefix='deflate') as executor:
+            pending = []
+            for top in tops:
+                pending.append(executor.submit(deflate_strip, top))
+                if len(pending) < self.png_threads * 2:
+                    continue
+                data, strip_checksum, length = pending.pop(0).result()
+                output.write(chunk(b'IDAT', data))
+                checksum = _adler32_combine(checksum, strip_checksum, length)
+            for future in pending:
+                data, strip_checksum, length = future.result()
+                output.write(chunk(b'IDAT', data))
+                checksum = _adler32_combine(checksum, strip_checksum, length)
+        output.write(chunk(b'IDAT', struct.pack('>I', checksum)))
+        output.write(chunk(b'IEND', b''))
+        return output.getvalue()
+    
+    def _encode_jpeg(self, canvas, target_bytes, history_key):
+        data, quality, full_encodes = self.jpeg_model.encode(canvas, target_bytes, history_key)
+        return {
+            'data': data,
+            'extension': '.jpg',
+            'content_type': 'image/jpeg',
+            'quality': quality,
+            'encodes': full_encodes,
+        }
+    
+    def _encode_webp(self, canvas, quality):
+        buffer = io.BytesIO()
+        canvas.save(buffer, 'WebP', quality=quality, method=self.webp_method)
+        return {
+            'data': buffer.getvalue(),
+            'extension': '.webp',
+            'content_type': 'image/webp',
+            'quality': quality,
+        }
+    
+    def _timed_encode(self, encode, *args):
+        started = time.perf_counter()
+        output = encode(*args)
+        output['seconds'] = time.perf_counter() - started
+        return output
+    
+    def encode_format(self, layout, canvas, format_name):
+        """Encode a rendered canvas into one output format"""
+        target_size_kb = self.target_size_kb(layout.width, layout.height)
+        if format_name == 'original':
+            return self._timed_encode(self._encode_master, canvas)
+        if format_name == 'jpeg':
+            output = self._timed_encode(
+                self._encode_jpeg,
+                canvas,
+                target_size_kb * 1024,
+                f"{layout.device_name}:{layout.width}x{layout.height}"
+            )
+            output['target_kb'] = target_size_kb
+            return output
+        if format_name == 'webp':
+            return self._timed_encode(self._encode_webp, canvas, 90 if target_size_kb > 1000 else 85)
+        raise ValueError(f"Unknown output format: {format_name}")
+    
+    def encode_wallpaper(self, layout, canvas):
+        """Encode a rendered canvas into every output format in parallel"""
+        started = time.perf_counter()
+        
+        if canvas.mode == 'RGBX':
+            # Strip-rendered: one encoder at a time keeps the peak to the largest one
+            outputs = {
+                format_name: self.encode_format(layout, canvas, format_name)
+                for format_name in self.output_formats
+            }
+            layout.timings['encode'] = time.perf_counter() - started
+            return outputs
+        
+        # Image.save keeps per-call options on the Image object, so encoders
+        # running at once can't share one; every format after the first gets a copy
+        futures = {
+            format_name: self.encoder_pool.submit(self.encode_format, layout, canvas if index == 0 else canvas.copy(),
+                                                  format_name)
+            for index, format_name in enumerate(self.output_formats)
+        }
+        outputs = {format_name: future.result() for format_name, future in futures.items()}
+        layout.timings['encode'] = time.perf_counter() - started
+        return outputs
+    
+    def master_label(self):
+        """Name of the lossless master's format for messages"""
+        return 'lossless WebP' if self.master_format == 'webp' else 'PNG'
+    
+    def store_wallpaper(self, layout, outputs):
+        """Save encoded outputs locally or upload them; returns the original's path or URL"""
+        filename_base = layout.output_name.lower().replace(' ', '_')
+        key_prefix = layout.variant.key_prefix if layout.variant is not None else ''
         
         print(f"Saved {filename_base}:")
-        print(f"  • Resolution: {width}x{height} (target: {target_size_kb}KB)")
-        print(f"  • Original PNG: {original_size:.1f}MB")
-        print(f"  • JPEG: {jpeg_size_kb:.0f}KB (quality={jpeg_quality})")
-        print(f"  • WebP: {webp_size_kb:.0f}KB (from JPEG, quality={webp_quality})")
+        print(f"  • Resolution: {layout.width}x{layout.height} "
+              f"(target: {self.target_size_kb(layout.width, layout.height)}KB)")
+        if 'original' in outputs:
+            print(f"  • Original {self.master_label()}: {len(outputs['original']['data']) / (1024 * 1024):.1f}MB")
+        if 'jpeg' in outputs:
+            jpeg = outputs['jpeg']
+            print(f"  • JPEG: {len(jpeg['data']) / 1024:.0f}KB (quality={jpeg['quality']}, {jpeg['encodes']} full encodes)")
+        if 'webp' in outputs:
+            webp = outputs['webp']
+            print(f"  • WebP: {len(webp['data']) / 1024:.0f}KB (quality={webp['quality']}, method={self.webp_method})")
         
-        # Upload to S3 if enabled, then clean up temp files
-        if self.s3_storage.enabled:
-            s3_urls = {}
-            
-            # Upload each format
-            for format_name, file_path in [
-                ('original', original_path),
-                ('jpeg', jpeg_path),
-                ('webp', webp_path)
-            ]:
-                s3_key = f"{format_name}/{filename_base}{os.path.splitext(file_path)[1]}"
-                url = self.s3_storage.upload_file(file_path, s3_key)
-                if url:
-                    s3_urls[format_name] = url
-                
-                # Remove temp file after upload
-                try:
-                    os.remove(file_path)
-                except OSError:
-                    pass
-            
-            # Clean up temp directory
+        for format_name, output in outputs.items():
+            output['key'] = f"{key_prefix}{format_name}/{filename_base}{output['extension']}"
+            output['sha256'] = hashlib.sha256(output['data']).hexdigest()
+        primary = outputs.get('original') or next(iter(outputs.values()))
+        
+        if self.sink == 'none':
+            # Nothing is written, so the manifest never records the device
+            print("  • Not stored (sink: none)")
+            return primary['key']
+        
+        # Save locally if S3 is disabled
+        if not self.s3_storage.enabled:
+            base_dir = './backgrounds'
+            for format_name, output in outputs.items():
+                output['location'] = f"{base_dir}/{output['key']}"
+                os.makedirs(os.path.dirname(output['location']), exist_ok=True)
+                if self._local_file_matches(output['location'], output['sha256']):
+                    continue  # Same bytes already on disk
+                with open(output['location'], 'wb') as f:
+                    f.write(output['data'])
+                output['stored'] = True
+            return primary['location']  # Return the local path (S3 disabled)
+        
+        # Upload every changed format from memory through the shared upload queue
+        futures = {}
+        for format_name, output in outputs.items():
+            previous_sha256 = self.manifest.output_sha256(layout.output_name, format_name)
+            if previous_sha256 is None:
+                previous_sha256 = self.s3_storage.object_sha256(output['key'])
+            if previous_sha256 == output['sha256']:
+                # Identical object already in the bucket
+                output['location'] = self.s3_storage.object_url(self.s3_storage.full_key(output['key']))
+                print(f"  • Unchanged {output['key']}, upload skipped")
+                continue
+            futures[format_name] = self.upload_queue.submit(
+                output['data'],
+                output['key'],
+                output['content_type'],
+                metadata={'sha256': output['sha256']}
+            )
+        
+        s3_urls = {
+            format_name: output['location']
+            for format_name, output in outputs.items()
+            if output.get('location')
+        }
+        for format_name, future in futures.items():
+            url = future.result()
+            if url:
+                outputs[format_name]['location'] = url
+                outputs[format_name]['stored'] = True
+                s3_urls[format_name] = url
+        
+        if s3_urls:
+            print(f"  • Uploaded to S3:")
+            for format_name, url in s3_urls.items():
+                print(f"    - {format_name}: {url}")
+        
+        # Return S3 URL instead of local path
+        return s3_urls.get('original', list(s3_urls.values())[0] if s3_urls else None)
+    
+    def _local_file_matches(self, path, sha256):
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest() == sha256
+        except OSError:
+            return False
+    
+    def produce_wallpaper(self, device_name, width, height, scale_factor=1):
+        """Render, encode and store one device; returns its manifest result or None"""
+        rendered = self.render_wallpaper(device_name, width, height, scale_factor)
+        if rendered is None:
+            return None
+        return self.finish_wallpaper(*rendered)
+    
+    def finish_wallpaper(self, layout, canvas):
+        """Encode and store a rendered canvas; returns its manifest result or None"""
+        outputs = self.encode_wallpaper(layout, canvas)
+        started = time.perf_counter()
+        location = self.store_wallpaper(layout, outputs)
+        layout.timings['store'] = time.perf_counter() - started
+        return self._device_result(layout, outputs, location)
+    
+    def _device_result(self, layout, outputs, location):
+        if location is None:
+            return None
+        jpeg = outputs.get('jpeg', {})
+        return {
+            'device': layout.output_name,
+            'location': location,
+            # A format that failed to save means the device renders again next run
+            'complete': all(output.get('location') for output in outputs.values()),
+            'inputs': self.render_inputs_hash(layout, layout.planned_ids),
+            'outputs': {
+                format_name: {
+                    'key': output['key'],
+                    'sha256': output['sha256'],
+                    'bytes': len(output['data']),
+                    'location': output.get('location'),
+                }
+                for format_name, output in outputs.items()
+            },
+            # Reported to RunMetrics by the process that runs the whole batch
+            'metrics': {
+                'resolution': [layout.width, layout.height],
+                'seconds': {stage: round(seconds, 4) for stage, seconds in layout.timings.items()},
+                'encode_seconds': {
+                    format_name: round(output['seconds'], 4) for format_name, output in outputs.items()
+                },
+                'jpeg_quality': jpeg.get('quality'),
+                'jpeg_encodes': jpeg.get('encodes'),
+                'jpeg_target_kb': jpeg.get('target_kb'),
+                'uploaded_bytes': sum(len(output['data']) for output in outputs.values() if output.get('stored')),
+                # Whole-process peak: with the thread backend devices share it
+                'peak_rss_bytes': _peak_rss_bytes(),
+            },
+        }
+    
+    def create_tilted_grid_wallpaper(self, device_name, width, height, scale_factor=1):
+        """Create a tilted poster grid wallpaper"""
+        result = self.produce_wallpaper(device_name, width, height, scale_factor)
+        return result['location'] if result else None
+    
+    def _render_devices_pipelined(self, devices, max_workers, scheduler, variants=(None,)):
+        """Render devices on threads while finished canvases are encoded and stored"""
+        finish_pool = ThreadPoolExecutor(max_workers=max_workers)
+        
+        def finish(layout, canvas):
             try:
-                os.rmdir(base_dir)
-            except OSError:
-                pass
+                return self.finish_wallpaper(layout, canvas)
+            except Exception as e:
+                _report_device_error(layout.device_name, e)
+                return None
+        
+        def render(variant, group, estimate):
+            futures = {}
+            try:
+                for layout, canvas in self.render_group(group, variant):
+                    # Hand off to the encode stage and move on to the next device
+                    futures[layout.output_name] = finish_pool.submit(finish, layout, canvas)
+            except Exception as e:
+                _report_device_error(group[0][0], e)
+            
+            # The memory reservation lasts until every device of the group is stored
+            if not futures:
+                scheduler.release(estimate)
+                return futures
+            remaining = [len(futures)]
+            lock = threading.Lock()
             
-            if s3_urls:
-                print(f"  • Uploaded to S3:")
-                for format_name, url in s3_urls.items():
-                    print(f"    - {format_name}: {url}")
+            def stored(_):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]:
+                        return
+                scheduler.release(estimate)
             
-            # Return S3 URL instead of local path
-            return s3_urls.get('original', list(s3_urls.values())[0] if s3_urls else None)
+            for future in list(futures.values()):
+                future.add_done_callback(stored)
+            return futures
         
-        return original_path  # Return the local path (S3 disabled)
+        render_futures = []
+        with finish_pool:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for estimate, (variant, group) in scheduler.admit(self._memory_jobs(devices, variants)):
+                    render_futures.append(executor.submit(render, variant, group, estimate))
+            finished = {}
+            for future in render_futures:
+                finished.update(future.result())
+            return [finished[name].result() if name in finished else None
+                    for name in self._output_names(devices, variants)]
     
+    def _estimated_peak_bytes(self, layout):
+        stacked_posters = (len(self.poster_pool) or self.POSTERS_PER_WALLPAPER) if self.compositor == 'numpy' else 0
+        return layout.estimated_peak_bytes(self.strip_height if self.streams(layout) else None, stacked_posters,
+                                           max(0, len(self.output_formats) - 1))
     
-    def create_all_device_sizes(self):
-        """Create poster collages for various device sizes using multi-threading"""
-        # Device configurations: (name, width, height, scale_factor)
-        devices = [
-            # Desktop displays
-            ("Desktop_4K", 3840, 2160, 1),
-            ("Desktop_QHD", 2560, 1440, 1.5),
-            ("Desktop_FHD", 1920, 1080, 2),
-            ("Laptop", 1366, 768, 2.5),
-            
-            # Tablet displays
-            ("iPad_Pro_12.9", 2732, 2048, 1),
-            ("iPad_Air", 2360, 1640, 1),
-            ("iPad_Mini", 2266, 1488, 1),
-            
-            # Phone displays
-            ("iPhone_14_Pro_Max", 1290, 2796, 1),
-            ("iPhone_14", 1170, 2532, 1),
-            ("Android_Large", 1440, 3200, 1),
-            ("Android_Standard", 1080, 2400, 1),
+    def _memory_jobs(self, devices, variants=(None,)):
+        """(estimate, (variant, group)) for every render group of every variant"""
+        groups = [
+            (sum(self._estimated_peak_bytes(GridLayout(*device_info)) for device_info in group), group)
+            for group in self.plan_render_groups(devices)
         ]
-        
+        return [(estimate, (variant, group)) for variant in variants for estimate, group in groups]
+    
+    def _output_names(self, devices, variants=(None,)):
+        """Output names in result order: every device of the first variant, then the next"""
+        return [
+            device_info[0] if variant is None else variant.output_name(device_info[0])
+            for variant in variants for device_info in devices
+        ]
+    
+    def _split_unchanged(self, devices, planned_ids, force_regenerate=False):
+        """(devices to render, names of devices the manifest says are current)"""
+        pending_devices = []
+        skipped_devices = []
+        for device_info in devices:
+            layout = GridLayout(*device_info)
+            if not force_regenerate and self.manifest.is_current(
+                    layout.device_name, self.render_inputs_hash(layout, planned_ids)):
+                skipped_devices.append(layout.device_name)
+            else:
+                pending_devices.append(device_info)
+        return pending_devices, skipped_devices
+    
+    def _render_settings(self):
+        """Render backend and worker count from RENDER_BACKEND / RENDER_WORKERS"""
         # Get number of CPU cores
         cpu_count = multiprocessing.cpu_count()
-        max_workers = min(cpu_count, 4)  # Use up to 4 threads
+        backend = os.getenv('RENDER_BACKEND', 'thread').lower()
+        if backend not in ('thread', 'process'):
+            print(f"Warning: Unknown RENDER_BACKEND '{backend}', using threads")
+            backend = 'thread'
+        
+        if os.getenv('RENDER_WORKERS'):
+            max_workers = max(1, int(os.getenv('RENDER_WORKERS')))
+        else:
+            max_workers = cpu_count  # How many run at once is decided by the memory budget
         
-        print(f"Generating poster collages using {max_workers} threads (detected {cpu_count} CPU cores)...")
+        worker_label = 'processes' if backend == 'process' else 'threads'
+        print(f"Generating poster collages using {max_workers} {worker_label} (detected {cpu_count} CPU cores)...")
         print("Creating high-resolution images with dynamic file sizes.\n")
+        return backend, max_workers
+    
+    def _render_all(self, devices, backend, max_workers, variants=(None,)):
+        """Render, encode and store every device of every variant; returns results in order"""
+        # Devices start largest first while their estimated memory fits the budget;
+        # canvases waiting for encode count too, up to two per worker
+        budget = render_memory_budget()
+        scheduler = MemoryScheduler(budget, max_workers * 2 if backend == 'thread' else max_workers)
+        if budget is not None:
+            print(f"Render memory budget: {budget / (1024 * 1024):.0f}MB\n")
+        
+        started = time.perf_counter()
+        if backend == 'process':
+            results = self._render_devices_in_processes(devices, max_workers, scheduler, variants)
+        else:
+            results = self._render_devices_pipelined(devices, max_workers, scheduler, variants)
+        self.metrics.stage('render', time.perf_counter() - started, devices=len(results),
+                           backend=backend, workers=max_workers)
+        return results
+    
+    def create_all_device_sizes(self, devices=None):
+        """Create poster collages for various device sizes using multi-threading"""
+        devices = default_devices() if devices is None else devices
+        backend, max_workers = self._render_settings()
+        
+        # Decide which devices changed since the last run before downloading anything
+        self.manifest.load()
+        force_regenerate = os.getenv('FORCE_REGENERATE', 'false').lower() == 'true' or self.sink == 'none'
         
-        # First, fetch and cache all posters
         print("Pre-fetching all posters...")
-        self.fetch_and_cache_posters()
-        print(f"Ready to generate wallpapers with {len(self.cached_posters)} cached posters\n")
+        download_tasks = None
+        if self.poster_pool:
+            planned_ids = list(self.poster_pool.planned_ids)
+        else:
+            self.plan_image_size(devices)
+            started = time.perf_counter()
+            download_tasks = self.fetch_poster_list()
+            planned_ids = [poster_path for poster_path, _ in download_tasks]
+            self.metrics.stage('fetch', time.perf_counter() - started, items=len(download_tasks))
         
-        generated_files = []
+        pending_devices, skipped_devices = self._split_unchanged(devices, planned_ids, force_regenerate)
+        if skipped_devices:
+            print(f"Skipping {len(skipped_devices)} unchanged devices: {', '.join(skipped_devices)}")
         
-        # Process devices in parallel
-        def generate_wallpaper_wrapper(device_info):
-            device_name, width, height, scale = device_info
-            try:
-                return self.create_tilted_grid_wallpaper(device_name, width, height, scale)
-            except Exception as e:
-                print(f"Error generating wallpaper for {device_name}: {e}")
-                import traceback
-                traceback.print_exc()
-                return None
+        results = []
+        if pending_devices:
+            # First, fetch and cache all posters
+            started = time.perf_counter()
+            self.fetch_and_cache_posters(download_tasks=download_tasks)
+            self.metrics.stage(
+                'download',
+                time.perf_counter() - started,
+                posters=len(self.poster_pool),
+                image_size=self.image_size,
+                bytes=self.tmdb.bytes_received,
+                revalidated=self.poster_cache.revalidated,
+                downloaded=self.poster_cache.downloaded,
+                retries=self.tmdb.retries
+            )
+            print(f"Ready to generate wallpapers with {len(self.poster_pool)} cached posters\n")
+            results = self._render_all(pending_devices, backend, max_workers)
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(generate_wallpaper_wrapper, devices))
-            generated_files = [r for r in results if r is not None]
+        generated_files = []
+        for result in results:
+            if result is None:
+                continue
+            generated_files.append(result['location'])
+            self.metrics.device(result)
+            if result['complete']:
+                self.manifest.record(result)
+        self.manifest.save()
+        self._finish_metrics(results, pending_devices, skipped_devices, backend)
         
         print(f"\n✅ Generated {len(generated_files)} wallpapers!")
         print("\nAll images feature a tilted grid layout with mixed movies and TV series.")
         if self.s3_storage.enabled:
             print("\nFiles uploaded to S3 storage with structure:")
-            print("  • original/ - Full quality PNG files")
+            if 'original' in self.output_formats:
+                print(f"  • original/ - Full quality {self.master_label()} files")
             print("  • jpeg/ - Optimized JPEG files with dynamic quality")
-            print("  • webp/ - WebP format (generated from JPEG for efficiency)")
-        else:
+            print("  • webp/ - WebP format (encoded from the rendered image)")
+        elif self.sink == 'local':
             print("\nFiles saved in ./backgrounds/ with subdirectories:")
-            print("  • original/ - Full quality PNG files")
+            if 'original' in self.output_formats:
+                print(f"  • original/ - Full quality {self.master_label()} files")
             print("  • jpeg/ - Optimized JPEG files with dynamic quality")
-            print("  • webp/ - WebP format (generated from JPEG for efficiency)")
+            print("  • webp/ - WebP format (encoded from the rendered image)")
         print("\nFile sizes are optimized for each device:")
+        print("  • 8K displays: up to 4MB")
         print("  • 4K displays: up to 2MB")
         print("  • QHD displays: up to 1.4MB")
         print("  • FHD displays: up to 1MB")
@@ -528,13 +2786,693 @@ class TMDBPosterGenerator:
         
         # Summary message
         if self.s3_storage.enabled:
+            uploads = self.upload_queue.summary()
+            if uploads:
+                print(f"\nUploaded {uploads['objects']} objects ({uploads['bytes'] / (1024 * 1024):.1f}MB, "
+                      f"{uploads['failed']} failed): p50 {uploads['p50_seconds']:.2f}s, max {uploads['max_seconds']:.2f}s")
             print(f"\n✅ All {len(generated_files)} wallpapers uploaded to S3 storage (no local files saved)")
+        elif self.sink == 'none':
+            print(f"\n✅ All {len(generated_files)} wallpapers encoded (not stored)")
         else:
             print(f"\n✅ All {len(generated_files)} wallpapers saved locally")
         
         return generated_files
+    
+    def plan_run(self, devices, variants=1):
+        """Print what a run would render from the device geometry alone; nothing is fetched"""
+        size_name = self.plan_image_size(devices)
+        derived_from = {}
+        for group in self.plan_render_groups(devices):
+            for device_info in group[1:]:
+                derived_from[device_info[0]] = group[0][0]
+        
+        rows = []
+        for device_info in devices:
+            layout = GridLayout(*device_info)
+            bounds = layout.grid_bounds((0, 0, layout.width, layout.height))
+            cells = sum(1 for _ in layout.cells_in(bounds)) if bounds else 0
+            if layout.device_name in derived_from:
+                mode, estimate = f"from {derived_from[layout.device_name]}", 0
+            else:
+                mode = 'strips' if self.streams(layout) else 'canvas'
+                estimate = self._estimated_peak_bytes(layout)
+            rows.append({
+                'device': layout.device_name,
+                'resolution': [layout.width, layout.height],
+                'pixels': layout.width * layout.height,
+                'tile': [layout.poster_width, layout.poster_height],
+                'grid': [layout.cols, layout.rows],
+                'cells': cells,
+                'estimated_peak_bytes': estimate,
+                'mode': mode,
+            })
+        
+        print(f"\n{'Device':<20} {'Output':>11} {'MPix':>6} {'Tile':>9} {'Grid':>7} {'Cells':>6} {'Est. MB':>8}  Render")
+        for row in rows:
+            print(f"{row['device']:<20} {'%dx%d' % tuple(row['resolution']):>11} {row['pixels'] / 1e6:>6.1f} "
+                  f"{'%dx%d' % tuple(row['tile']):>9} {'%dx%d' % tuple(row['grid']):>7} {row['cells']:>6} "
+                  f"{row['estimated_peak_bytes'] / (1024 * 1024):>8.0f}  {row['mode']}")
+        
+        budget = render_memory_budget()
+        print(f"\n{len(rows)} devices x {variants} variant(s) = {len(rows) * variants} wallpapers, "
+              f"{sum(row['pixels'] for row in rows) * variants / 1e6:.0f} megapixels")
+        print(f"Poster size: {size_name}, formats: {', '.join(self.output_formats)}, sink: {self.sink}")
+        print(f"Largest render: {max((row['estimated_peak_bytes'] for row in rows), default=0) / (1024 * 1024):.0f}MB, "
+              f"memory budget: {'unlimited' if budget is None else '%.0fMB' % (budget / (1024 * 1024))}")
+        return rows
+    
+    def plan_variants(self, count, seed, genres=None):
+        """Pick the posters, order and tilt of count variants from the cached pool"""
+        pool = sorted(self.poster_pool.poster_ids)  # Independent of download order
+        angle_range = os.getenv('BATCH_ANGLE_RANGE', '-20,-10')
+        angle_min, angle_max = sorted(float(value) for value in angle_range.split(','))
+        
+        variants = []
+        for index in range(count):
+            rng = random.Random(f"{seed}:{index}")
+            genre = genres[index % len(genres)] if genres else None
+            candidates = pool
+            if genre is not None:
+                matching = [poster_id for poster_id in pool if genre in self.poster_genres.get(poster_id, ())]
+                if len(matching) >= self.BATCH_MIN_GENRE_POSTERS:
+                    candidates = matching
+                else:
+                    print(f"Warning: Only {len(matching)} posters for genre {genre}, "
+                          f"variant {index} uses the whole pool")
+                    genre = None
+            poster_ids = rng.sample(candidates, min(self.POSTERS_PER_WALLPAPER, len(candidates)))
+            angle = round(rng.uniform(angle_min, angle_max), 1)
+            variants.append(WallpaperVariant(seed, index, poster_ids, angle, genre))
+        return variants
+    
+    def create_variant_batch(self, count, seed, devices=None, genres=None):
+        """Render count randomized variants of every device from one poster pool
+        
+        The pool is fetched and decoded once and tiles are shared by every
+        variant; outputs are stored as they finish under variants/<seed>/.
+        The same seed and pool always give the same wallpapers.
+        """
+        devices = default_devices() if devices is None else devices
+        backend, max_workers = self._render_settings()
+        pool_size = int(os.getenv('BATCH_POOL_SIZE', '80'))
+        
+        self.plan_image_size(devices)
+        started = time.perf_counter()
+        download_tasks = self.fetch_poster_list(count=pool_size)
+        self.metrics.stage('fetch', time.perf_counter() - started, items=len(download_tasks))
+        
+        started = time.perf_counter()
+        self.fetch_and_cache_posters(download_tasks=download_tasks, refresh=True)
+        self.metrics.stage('download', time.perf_counter() - started, posters=len(self.poster_pool),
+                           image_size=self.image_size, bytes=self.tmdb.bytes_received)
+        if not self.poster_pool:
+            print("Error: No posters available for the batch")
+            return []
+        
+        variants = self.plan_variants(count, seed, genres)
+        print(f"Rendering {len(variants)} variants of {len(devices)} devices (seed {seed}, "
+              f"{len(self.poster_pool)} posters in the pool)\n")
+        results = self._render_all(devices, backend, max_workers, variants)
+        
+        for result in results:
+            if result is not None:
+                self.metrics.device(result)
+        self.save_variant_index(seed, variants, devices, results)
+        self._finish_metrics(results, results, [], backend)
+        
+        generated = [result['location'] for result in results if result]
+        print(f"\n✅ Generated {len(generated)} of {len(results)} variant wallpapers")
+        return generated
+    
+    def save_variant_index(self, seed, variants, devices, results):
+        """Write variants/<seed>/index.json: each variant's posters, tilt and output keys"""
+        if not variants:
+            return
+        results = iter(results)
+        entries = []
+        for variant in variants:
+            entry = variant.describe()
+            entry['outputs'] = {}
+            for device_info in devices:
+                result = next(results)
+                if result is not None:
+                    entry['outputs'][device_info[0]] = {
+                        format_name: output['key'] for format_name, output in result['outputs'].items()
+                    }
+            entries.append(entry)
+        
+        data = json.dumps({
+            'seed': str(seed),
+            'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'image_size': self.image_size,
+            'variants': entries,
+        }, indent=2).encode('utf-8')
+        key = f"{variants[0].key_prefix}index.json"
+        if self.s3_storage.enabled:
+            self.s3_storage.upload_bytes(data, key, 'application/json')
+        else:
+            path = os.path.join('./backgrounds', key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+    
+    def publish_run(self, queue, devices=None, variant_count=None, seed=None, genres=None):
+        """Snapshot the poster set and publish one job per render group (and variant); returns the run id
+        
+        The posters are downloaded here so the shared poster cache is warm;
+        workers only revalidate them.
+        """
+        devices = default_devices() if devices is None else devices
+        self.plan_image_size(devices)
+        pool_size = int(os.getenv('BATCH_POOL_SIZE', '80')) if variant_count else self.POSTERS_PER_WALLPAPER
+        download_tasks = self.fetch_poster_list(count=pool_size)
+        self.fetch_and_cache_posters(download_tasks=download_tasks, refresh=True)
+        if not self.poster_pool:
+            print("Error: No posters available, nothing published")
+            return None
+        
+        variants = self.plan_variants(variant_count, seed, genres) if variant_count else [None]
+        if variants == [None]:
+            # Like a normal run, devices rendered from the same inputs before are left out
+            self.manifest.load()
+            force_regenerate = os.getenv('FORCE_REGENERATE', 'false').lower() == 'true' or self.sink == 'none'
+            devices, skipped_devices = self._split_unchanged(devices, self.poster_pool.planned_ids, force_regenerate)
+            if skipped_devices:
+                print(f"Skipping {len(skipped_devices)} unchanged devices: {', '.join(skipped_devices)}")
+            if not devices:
+                print("\n✅ Every device is up to date, nothing published")
+                return None
+        
+        run_id = f"{time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}-{uuid.uuid4().hex[:6]}"
+        snapshot = {
+            'image_size': self.image_size,
+            'decode_size': self.decode_size,
+            'formats': list(self.output_formats),
+            # The full plan: workers drop the same failed and duplicate posters
+            'posters': [list(task) for task in download_tasks],
+            'devices': [list(device_info) for device_info in devices],
+            'seed': None if seed is None else str(seed),
+            'variants': [variant.describe() for variant in variants if variant is not None],
+        }
+        jobs = [
+            (estimate, {
+                'group': [list(device_info) for device_info in group],
+                'variant': variant.index if variant is not None else None,
+            })
+            for estimate, (variant, group) in self._memory_jobs(devices, variants)
+        ]
+        queue.publish(run_id, snapshot, jobs)
+        print(f"\n✅ Published run {run_id}: {len(jobs)} jobs for {len(devices)} devices to {queue.path}")
+        return run_id
+    
+    def _variants_from_snapshot(self, snapshot):
+        return {
+            entry['index']: WallpaperVariant(snapshot['seed'], entry['index'], entry['posters'],
+                                             entry['angle'], entry['genre'])
+            for entry in snapshot['variants']
+        }
+    
+    def work_queue(self, queue, run_id=None, worker_id=None):
+        """Claim and render jobs of a run until none are left; returns the results rendered here
+        
+        While other workers hold leases the worker keeps polling, so it picks
+        up their jobs if their leases run out. The worker that sees the last
+        job finish writes the manifest (or the variant index).
+        """
+        run_id = run_id or queue.latest_run()
+        snapshot = queue.snapshot(run_id) if run_id else None
+        if snapshot is None:
+            print("No unfinished runs in the queue")
+            return []
+        worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        
+        # Same posters, in the same order, as the publisher saw
+        self.set_image_size(snapshot['image_size'], snapshot['decode_size'])
+        self.output_formats = tuple(snapshot['formats'])
+        started = time.perf_counter()
+        self.fetch_and_cache_posters(download_tasks=[tuple(poster) for poster in snapshot['posters']], refresh=True)
+        self.metrics.stage('download', time.perf_counter() - started, posters=len(self.poster_pool),
+                           image_size=self.image_size, bytes=self.tmdb.bytes_received)
+        variants = self._variants_from_snapshot(snapshot)
+        self.manifest.load()  # Lets unchanged outputs skip their upload
+        
+        print(f"\nWorker {worker_id} on run {run_id}")
+        poll_seconds = float(os.getenv('QUEUE_POLL_SECONDS', '5'))
+        results = []
+        started = time.perf_counter()
+        while True:
+            claimed = queue.claim(run_id, worker_id)
+            if claimed is None:
+                if queue.counts(run_id).get('leased'):
+                    time.sleep(poll_seconds)  # Others are still rendering; their jobs may come back
+                    continue
+                break
+            
+            job_id, payload = claimed
+            group = [tuple(device_info) for device_info in payload['group']]
+            variant = variants.get(payload['variant'])
+            stop_renewing = queue.hold_lease(job_id, worker_id)
+            try:
+                job_results = [result for result in self.produce_group(group, variant) if result]
+            finally:
+                stop_renewing.set()
+            
+            results.extend(job_results)
+            for result in job_results:
+                self.metrics.device(result)
+            if len(job_results) == len(group) and all(result['complete'] for result in job_results):
+                recorded = queue.complete(job_id, worker_id, job_results)
+            else:
+                failed = len(group) - sum(1 for result in job_results if result['complete'])
+                recorded = queue.fail(job_id, worker_id, f"{failed} of {len(group)} devices failed")
+            if not recorded:
+                # The lease ran out and another worker claimed the job; its attempt counts
+                print(f"Warning: Job {job_id} is leased to another worker, not recording this attempt")
+        self.metrics.stage('render', time.perf_counter() - started, devices=len(results), backend='queue')
+        
+        if queue.finish(run_id):
+            self.finish_run(queue, run_id, snapshot, variants)
+        self._finish_metrics(results, results, [], 'queue')
+        print(f"\n✅ Worker {worker_id} rendered {len(results)} wallpapers; run {run_id}: {queue.counts(run_id)}")
+        return results
+    
+    def finish_run(self, queue, run_id, snapshot, variants):
+        """Record a finished queued run: the manifest, or the variant index for a batch"""
+        results = queue.results(run_id)
+        if variants:
+            devices = [tuple(device_info) for device_info in snapshot['devices']]
+            by_name = {result['device']: result for result in results}
+            ordered = [by_name.get(name) for name in self._output_names(devices, list(variants.values()))]
+            self.save_variant_index(snapshot['seed'], list(variants.values()), devices, ordered)
+        else:
+            # Workers only read the manifest; it is written once, here
+            self.manifest.load()
+            for result in results:
+                self.manifest.record(result)
+            self.manifest.save()
+        print(f"Run {run_id} finished: {len(results)} wallpapers")
+    
+    def _finish_metrics(self, results, pending_devices, skipped_devices, backend):
+        """Write the run summary to the metrics outputs"""
+        completed = [result for result in results if result and result['complete']]
+        failed = len(pending_devices) - len(completed)
+        
+        poster_lookups = self.poster_cache.revalidated + self.poster_cache.downloaded
+        tiles = self.tile_cache.stats()
+        tile_lookups = tiles['hits'] + tiles['misses']
+        
+        self.metrics.finish(
+            status='success' if failed == 0 else 'failed',
+            devices_generated=len(completed),
+            devices_skipped=len(skipped_devices),
+            devices_failed=failed,
+            bytes_downloaded=self.tmdb.bytes_received,
+            bytes_uploaded=sum(result['metrics']['uploaded_bytes'] for result in results if result),
+            tmdb_retries=self.tmdb.retries,
+            poster_cache_hit_ratio=(round(self.poster_cache.revalidated / poster_lookups, 4)
+                                    if poster_lookups else None),
+            # Worker processes keep their own tile caches, so this is thread-backend only
+            tile_cache_hit_ratio=(round(tiles['hits'] / tile_lookups, 4)
+                                  if tile_lookups and backend == 'thread' else None),
+            uploads=self.upload_queue.summary() if self.upload_queue else None
+        )
+    
+    def _render_devices_in_processes(self, devices, max_workers, scheduler, variants=(None,)):
+        """Render devices on a process pool reading posters from shared memory"""
+        pool = self.poster_pool
+        store = SharedPosterStore.create(pool.posters, pool.poster_ids)
+        
+        print(f"Shared poster store: {store.shm.size / (1024 * 1024):.1f}MB for {len(store.index)} posters")
+        
+        try:
+            # Spawn avoids forking a parent that has live thread pools
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=context,
+                initializer=_init_render_worker,
+                initargs=(
+                    self.api_key,
+                    store.descriptor(),
+                    pool.planned_ids,
+                    self.manifest.devices,
+                    (self.image_size, self.decode_size),
+                    (self.sink, self.output_formats)
+                )
+            ) as executor:
+                jobs = []
+                for estimate, (variant, group) in scheduler.admit(self._memory_jobs(devices, variants)):
+                    try:
+                        future = executor.submit(_render_group_in_worker, group, variant)
+                    except BrokenProcessPool as e:
+                        # A worker died and the pool takes no more work; fail the rest below
+                        future = Future()
+                        future.set_exception(e)
+                    future.add_done_callback(lambda _, estimate=estimate: scheduler.release(estimate))
+                    jobs.append((group, future))
+                
+                finished = {}
+                for group, future in jobs:
+                    try:
+                        finished.update((result['device'], result) for result in future.result() if result)
+                    except Exception as e:
+                        # Usually BrokenProcessPool (a worker was killed, e.g. out of memory)
+                        for device_info in group:
+                            _report_device_error(device_info[0], e)
+                return [finished.get(name) for name in self._output_names(devices, variants)]
+        finally:
+            store.close()
+
+
+class WallpaperServer:
+    """HTTP service rendering wallpapers on demand from a warm poster set
+    
+    GET /wallpaper?width=1920&height=1080&scale=1&format=jpeg renders any
+    size in png, jpeg or webp. Encoded results are kept in an LRU cache keyed
+    by the parameters and the poster-set version; concurrent identical
+    requests share one render, and at most SERVER_WORKERS renders run at once
+    (further requests queue, then get 503 once SERVER_MAX_QUEUE are waiting).
+    """
+    
+    FORMATS = {'png': 'original', 'jpeg': 'jpeg', 'jpg': 'jpeg', 'webp': 'webp'}
+    
+    def __init__(self, generator, host=None, port=None, workers=None, max_queue=None,
+                 cache_bytes=None, max_pixels=None, refresh_minutes=None):
+        self.generator = generator
+        # Clients pick the sizes, so their JPEG history stays in memory and bounded
+        # rather than growing the on-disk file the batch runs share
+        generator.jpeg_model = JpegQualityModel(history_path='', optimize=generator.jpeg_model.optimize,
+                                                max_entries=256)
+        self.host = host or os.getenv('SERVER_HOST', '0.0.0.0')
+        self.port = int(port or os.getenv('SERVER_PORT', '8080'))
+        workers = workers or max(1, int(os.getenv('SERVER_WORKERS', '2')))
+        self.max_queue = max_queue or max(1, int(os.getenv('SERVER_MAX_QUEUE', str(workers * 4))))
+        if cache_bytes is None:
+            cache_bytes = int(float(os.getenv('SERVER_CACHE_MB', '256')) * 1024 * 1024)
+        self.cache_bytes = cache_bytes
+        self.max_pixels = max_pixels or int(os.getenv('SERVER_MAX_PIXELS', '40000000'))
+        if refresh_minutes is None:
+            refresh_minutes = float(os.getenv('SERVER_REFRESH_MINUTES', '360'))
+        self.refresh_minutes = refresh_minutes
+        
+        self.version = None
+        self._render_slots = threading.BoundedSemaphore(workers)
+        self._waiting = 0
+        self._cache = OrderedDict()  # (width, height, scale, format, version) -> encoded result
+        self._cached_bytes = 0
+        self._inflight = {}  # key -> Future shared by identical requests
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+    
+    def load_posters(self, refresh=False):
+        """Fetch the poster set and drop cached results rendered from an older one"""
+        pool = self.generator.fetch_and_cache_posters(refresh=refresh)
+        version = f"{self.generator.image_size}-{pool.version}"
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._cache.clear()
+                self._cached_bytes = 0
+        print(f"Poster set {version}: {len(pool)} posters")
+        return version
+    
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_minutes * 60)
+            try:
+                self.load_posters(refresh=True)
+            except Exception as e:
+                print(f"Error refreshing posters: {e}")
+    
+    def parse_request(self, query):
+        """Validate query parameters; returns (width, height, scale, format) or raises ValueError"""
+        try:
+            width = int(query.get('width', [''])[0])
+            height = int(query.get('height', [''])[0])
+            scale = float(query.get('scale', ['1'])[0])
+        except ValueError:
+            raise ValueError("width and height must be integers and scale a number")
+        format_name = self.FORMATS.get(query.get('format', ['jpeg'])[0].lower())
+        if format_name is None:
+            raise ValueError(f"format must be one of {', '.join(sorted(self.FORMATS))}")
+        if width < 1 or height < 1 or not 0.25 <= scale <= 4:
+            raise ValueError("width and height must be positive and scale between 0.25 and 4")
+        # The output size, computed as GridLayout does
+        output_width, output_height = int(width * scale), int(height * scale)
+        if output_width < 1 or output_height < 1:
+            raise ValueError("scaled width and height must be at least 1 pixel")
+        if output_width * output_height > self.max_pixels:
+            raise ValueError(f"output is limited to {self.max_pixels} pixels")
+        return width, height, scale, format_name
+    
+    def get(self, width, height, scale, format_name):
+        """Encoded wallpaper for the parameters and how it was served (HIT, MISS or SHARED)"""
+        key = (width, height, scale, format_name, self.version)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return result, 'HIT'
+            
+            future = self._inflight.get(key)
+            if future is not None:
+                self.shared += 1
+                owner = False
+            else:
+                if self._waiting >= self.max_queue:
+                    raise ServerBusy()
+                future = Future()
+                self._inflight[key] = future
+                self._waiting += 1
+                self.misses += 1
+                owner = True
+        
+        if not owner:
+            return future.result(), 'SHARED'
+        
+        try:
+            with self._render_slots:
+                with self._lock:
+                    self._waiting -= 1
+                result = self._render(width, height, scale, format_name)
+            self._store(key, result)
+            future.set_result(result)
+            return result, 'MISS'
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+    
+    def _render(self, width, height, scale, format_name):
+        device_name = f"custom_{width}x{height}"
+        rendered = self.generator.render_wallpaper(device_name, width, height, scale)
+        if rendered is None:
+            raise RuntimeError("No posters available")
+        layout, canvas = rendered
+        output = self.generator.encode_format(layout, canvas, format_name)
+        output['sha256'] = hashlib.sha256(output['data']).hexdigest()
+        return output
+    
+    def _store(self, key, result):
+        """Insert a result and evict least recently used results over budget"""
+        size = len(result['data'])
+        if size > self.cache_bytes:
+            return
+        with self._lock:
+            if key[-1] != self.version:
+                return  # Rendered from a poster set that has since been replaced
+            self._cache[key] = result
+            self._cached_bytes += size
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted['data'])
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'poster_set': self.version,
+                'posters': len(self.generator.poster_pool),
+                'cached_results': len(self._cache),
+                'cached_bytes': self._cached_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared': self.shared,
+                'waiting': self._waiting,
+            }
+    
+    def serve_forever(self):
+        """Load posters, then serve until interrupted"""
+        self.generator.plan_image_size(default_devices())
+        self.load_posters()
+        if self.refresh_minutes > 0:
+            threading.Thread(target=self._refresh_loop, daemon=True).start()
+        
+        from http.server import ThreadingHTTPServer
+        httpd = ThreadingHTTPServer((self.host, self.port), self._handler())
+        httpd.daemon_threads = True
+        print(f"Serving wallpapers on http://{self.host}:{self.port}/wallpaper")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+    
+    def _handler(self):
+        from http.server import BaseHTTPRequestHandler
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def _send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def _send_json(self, status, payload, headers=None):
+                headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+                self._send(status, json.dumps(payload).encode('utf-8'), headers)
+            
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                if parts.path == '/health':
+                    self._send_json(200, server.stats())
+                    return
+                if parts.path != '/wallpaper':
+                    self._send_json(404, {'error': 'not found'})
+                    return
+                
+                try:
+                    params = server.parse_request(parse_qs(parts.query))
+                    result, cache_status = server.get(*params)
+                except ValueError as e:
+                    self._send_json(400, {'error': str(e)})
+                    return
+                except ServerBusy:
+                    self._send_json(503, {'error': 'too many renders queued'}, {'Retry-After': '5'})
+                    return
+                except Exception as e:
+                    print(f"Error rendering {self.path}: {e}")
+                    self._send_json(500, {'error': 'render failed'})
+                    return
+                
+                etag = f'"{result["sha256"]}"'
+                headers = {
+                    'ETag': etag,
+                    'Cache-Control': 'public, max-age=3600',
+                    'X-Cache': cache_status,
+                    'X-Poster-Set': server.version,
+                }
+                if self.headers.get('If-None-Match') == etag:
+                    self._send(304, headers=headers)
+                    return
+                headers['Content-Type'] = result['content_type']
+                self._send(200, result['data'], headers)
+        
+        return Handler
+
+
+class ServerBusy(Exception):
+    """Raised when the render queue of WallpaperServer is full"""
+
+
+# Per-process state for the process render backend
+_worker_generator = None
+_worker_store = None
+
+
+def _report_device_error(device_name, error):
+    print(f"Error generating wallpaper for {device_name}: {error}")
+    import traceback
+    traceback.print_exc()
+
+
+def _init_render_worker(api_key, store_descriptor, planned_ids, manifest_devices, image_size, outputs):
+    """Set up a render worker process around the shared poster store"""
+    global _worker_generator, _worker_store
+    _worker_store = SharedPosterStore.attach(store_descriptor)
+    _worker_generator = TMDBPosterGenerator(api_key, *outputs)
+    _worker_generator.set_image_size(*image_size)
+    _worker_generator.manifest = RenderManifest(_worker_generator.s3_storage, manifest_devices)
+    _worker_generator.poster_pool = PosterPool(_worker_store.poster_ids(), _worker_store.images(),
+                                                  planned_ids=planned_ids)
+
+
+def _render_group_in_worker(group, variant=None):
+    return _worker_generator.produce_group(group, variant)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render tilted TMDB poster grid wallpapers")
+    parser.add_argument('command', nargs='?', choices=['run', 'batch', 'serve', 'publish', 'worker', 'status'],
+                        default='run',
+                        help="run: one wallpaper per device (default); batch: seeded variants "
+                             "per device; serve: render on request over HTTP; publish: queue a run "
+                             "for workers; worker: render queued jobs; status: show queued runs")
+    known_devices = [device_info[0] for device_info in DEVICES + EXTENDED_DEVICES]
+    parser.add_argument('--devices', nargs='+', choices=known_devices, metavar='DEVICE',
+                        help=f"Devices to render (default: all). Known: {', '.join(known_devices)}")
+    parser.add_argument('--formats', nargs='+', choices=TMDBPosterGenerator.OUTPUT_FORMATS,
+                        help="Output formats (default: original jpeg webp)")
+    parser.add_argument('--sink', choices=['s3', 'local', 'none'],
+                        help="Where outputs go (default: s3 if S3_ENABLED=true, else local); "
+                             "none encodes without storing")
+    parser.add_argument('--plan', action='store_true',
+                        help="Print resolutions, tiles and estimated memory per device without fetching anything")
+    parser.add_argument('--variants', type=int, default=int(os.getenv('BATCH_VARIANTS', '7')),
+                        help="batch: variants per device")
+    parser.add_argument('--seed', default=os.getenv('BATCH_SEED') or time.strftime('%Y-%m-%d', time.gmtime()),
+                        help="batch: variant seed (default: today's date)")
+    parser.add_argument('--genres', nargs='+', type=int,
+                        default=[int(genre) for genre in os.getenv('BATCH_GENRES', '').split(',') if genre.strip()],
+                        help="batch: TMDB genre ids, one per variant in turn")
+    parser.add_argument('--batch', action='store_true',
+                        help="publish: queue seeded variants (--variants, --seed, --genres) instead of a run")
+    parser.add_argument('--queue', help="publish/worker/status: queue database (default: QUEUE_PATH)")
+    parser.add_argument('--run', help="worker/status: run id (default: the latest unfinished run)")
+    args = parser.parse_args(argv)
+    if args.formats and os.getenv('MASTER_FORMAT', 'png').lower() == 'none' and set(args.formats) == {'original'}:
+        parser.error("--formats original writes nothing with MASTER_FORMAT=none")
+    return args
+
 
-def main():
+def main(argv=None):
+    # Load environment variables before reading any settings
+    from dotenv import load_dotenv
+    load_dotenv()
+    args = parse_args(argv)
+    
+    devices = default_devices()
+    if args.devices:
+        devices = [device_info for device_info in DEVICES + EXTENDED_DEVICES if device_info[0] in args.devices]
+    
+    if args.plan:
+        generator = TMDBPosterGenerator(None, sink=args.sink or 'none', output_formats=args.formats, plan_only=True)
+        batch = args.command == 'batch' or (args.command == 'publish' and args.batch)
+        generator.plan_run(devices, args.variants if batch else 1)
+        return
+    
+    if args.command == 'status':
+        queue = RenderQueue(args.queue)
+        for run_id, created_at, finished_at in ([(args.run, None, None)] if args.run else queue.runs()):
+            state = 'finished' if finished_at else 'open'
+            print(f"{run_id}: {state}, jobs {queue.counts(run_id)}")
+        return
+    if args.command == 'worker':
+        # Workers only download poster images, which needs no API key
+        generator = TMDBPosterGenerator(os.getenv('TMDB_API_KEY'), sink=args.sink)
+        generator.work_queue(RenderQueue(args.queue), args.run)
+        return
+    
     # Get API key from environment variable
     API_KEY = os.getenv('TMDB_API_KEY', 'your_tmdb_api_key_here')
     
@@ -545,12 +3483,25 @@ def main():
     
     print("TMDB Poster Wallpaper Generator")
     print("="*32)
+    
+    generator = TMDBPosterGenerator(API_KEY, sink=args.sink, output_formats=args.formats)
+    if args.command == 'serve':
+        # Render on request over HTTP instead of the batch run
+        WallpaperServer(generator).serve_forever()
+        return
+    if args.command == 'publish':
+        # Split the run into queued jobs for any number of workers
+        generator.publish_run(RenderQueue(args.queue), devices, args.variants if args.batch else None,
+                              args.seed, args.genres)
+        return
+    if args.command == 'batch':
+        # Several randomized variants per device, e.g. a daily rotation set
+        generator.create_variant_batch(args.variants, args.seed, devices, genres=args.genres)
+        return
+    
     print("Creating tilted grid wallpapers for multiple devices...")
     print()
-    
-    generator = TMDBPosterGenerator(API_KEY)
-    generator.create_all_device_sizes()
+    generator.create_all_device_sizes(devices)
 
 if __name__ == "__main__":
     main()
-